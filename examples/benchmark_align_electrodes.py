@@ -0,0 +1,52 @@
+import os, time, numpy as np
+from pyhemo.data_io import load_tri
+from pyhemo.geometry import align_electrodes, ptriprojn, lmoutrn, routlm
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATADIR = os.path.join(BASEDIR, 'tests', 'test_data')
+
+
+# brute force reference implementation (pyhemo <= 0.3)
+def align_electrodes_all_triangles(elc, scalp):
+    pnt, tri = scalp
+    pnt, tri, elc = np.array(pnt), np.array(tri), np.array(elc)
+    prj = np.zeros(elc.shape)
+    for i in range(len(elc)):
+        proj, dist = ptriprojn(pnt[tri[:,0],:], pnt[tri[:,1],:],
+                               pnt[tri[:,2],:], np.array([elc[i,:]]), 1)
+        idx = np.argmin(abs(dist))
+        v1, v2, v3 = [pnt[np.newaxis, tri[idx,j],:] for j in range(3)]
+        la, mu, _, _ = lmoutrn(v1, v2, v3, proj[np.newaxis, idx,:])
+        prj[i,:] = routlm(v1[0], v2[0], v3[0], la[0], mu[0])
+    return prj
+
+
+def subdivide(pos, tri):
+    """Split every triangle into four"""
+    edges = np.sort(np.vstack((tri[:,[0,1]], tri[:,[1,2]], tri[:,[2,0]])),
+                    axis=1)
+    edges, inv = np.unique(edges, axis=0, return_inverse=True)
+    mid = len(pos) + inv.ravel().reshape((3, len(tri))).T
+    pos = np.vstack((pos, (pos[edges[:,0]] + pos[edges[:,1]]) / 2.))
+    a, b, c = tri.T
+    ab, bc, ca = mid.T
+    tri = np.vstack((np.c_[a, ab, ca], np.c_[ab, b, bc], np.c_[ca, bc, c],
+                     np.c_[ab, bc, ca]))
+    return pos, tri
+
+
+scalp = load_tri(os.path.join(DATADIR, 'scalp.tri'))
+with open(os.path.join(DATADIR, 'electrodes_not_aligned.txt'), 'r') as f:
+    elc = np.array([[float(x) for x in line.split()] for line in f])
+print('%8s %6s %12s %12s %10s' % ('faces', 'elecs', 'all_tris', 'kdtree',
+                                  'max_diff'))
+for level in range(3):
+    start = time.perf_counter()
+    ref = align_electrodes_all_triangles(elc, scalp)
+    t_ref = time.perf_counter() - start
+    start = time.perf_counter()
+    prj = align_electrodes(elc, scalp)
+    t_new = time.perf_counter() - start
+    print('%8d %6d %10.1fms %10.1fms %10.2g' % (len(scalp[1]), len(elc),
+          1000*t_ref, 1000*t_new, np.max(np.abs(prj - ref))))
+    scalp = subdivide(*scalp)
@@ -0,0 +1,75 @@
+import os, time, numpy as np
+from collections import OrderedDict
+from pyhemo.data_io import load_tri
+from pyhemo.OpenMEEGHead import OpenMEEGHead
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATADIR = os.path.join(BASEDIR, 'tests', 'test_data')
+CALLS = 2000
+
+
+def load_txt(fn):
+    with open(fn, 'r') as f:
+        return np.array([[float(x) for x in line.split()] for line in f])
+
+
+def calls_per_second(forward, positions, moments):
+    start = time.perf_counter()
+    for pos, mom in zip(positions, moments):
+        forward(pos, mom)
+    return len(positions) / (time.perf_counter() - start)
+
+
+def report(name, head, positions, moments):
+    # V of one dipole at a time (pyhemo <= 0.3)
+    def V(pos, mom):
+        head.add_dipoles([np.hstack((pos, mom))])
+        return head.V(head_sm)
+    head_sm = 'dsm' if isinstance(head, OpenMEEGHead) else 'Venant'
+    def stored(pos, mom):
+        return head.forward(pos, mom, cache=True)
+    rates = [calls_per_second(V, positions[:20], moments[:20]),
+             calls_per_second(head.forward, positions[:200], moments[:200]),
+             calls_per_second(stored, positions, moments),
+             calls_per_second(stored, positions, moments)]
+    print('%-10s %12.0f %12.0f %12.0f %12.0f' % tuple([name] + rates))
+
+
+# random dipoles around the centre of the head, each position once
+np.random.seed(0)
+num_positions = CALLS // 10
+positions = np.random.randn(num_positions, 3) * 5
+positions = positions[np.random.choice(num_positions, CALLS)]
+moments = np.random.randn(CALLS, 3)
+print('calls per second:')
+print('%-10s %12s %12s %12s %12s' % ('head', 'V', 'new pos', 'forward',
+                                     'cached'))
+
+# BEM: three nested shells obtained by shrinking the scalp
+pos, tri = load_tri(os.path.join(DATADIR, 'scalp.tri'))
+centre = np.mean(pos, axis=0)
+geometry = OrderedDict([(tissue, (centre + scale*(pos-centre), tri))
+                        for tissue, scale in [('brain', 0.8), ('skull', 0.9),
+                                              ('scalp', 1.0)]])
+cond = {'brain': 0.33, 'skull': 0.0041, 'scalp': 0.33}
+sensors = load_txt(os.path.join(DATADIR, 'electrodes_aligned.txt'))
+bem = OpenMEEGHead(cond, geometry, sensors)
+bem.T # transfer matrix is shared by all calls
+report('OpenMEEG', bem, centre + positions, moments)
+# new positions on a fresh head, the first call computes the transfer matrix
+fresh = OpenMEEGHead(cond, geometry, sensors)
+fresh.A
+print('%-10s %12s %12.0f' % ('(fresh)', '', calls_per_second(fresh.forward,
+      centre + positions[:200], moments[:200])))
+
+# FEM (if duneuropy is installed)
+try:
+    from pyhemo.DUNEuroHead import DUNEuroHead
+except ImportError:
+    print('DUNEuro    (duneuropy not installed)')
+else:
+    fem = DUNEuroHead({'icosphere162': 1.79, 'icosphere42': 0.33},
+                      os.path.join(DATADIR, 'icospheres.msh'),
+                      load_txt(os.path.join(DATADIR, 'electrodes_ico162.txt')))
+    fem.h2em
+    report('DUNEuro', fem, positions / 100, moments)
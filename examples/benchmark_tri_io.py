@@ -0,0 +1,56 @@
+import os, time, tempfile, numpy as np
+from pyhemo.data_io import load_tri, write_tri, get_normals
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATADIR = os.path.join(BASEDIR, 'examples', 'colin')
+REPEATS = 20
+
+
+# line by line reference implementation (pyhemo <= 0.3)
+def load_tri_lines(filename):
+    with open(filename, "r") as fid:
+        lines = fid.readlines()
+    n_nodes = int(lines[0].split()[-1])
+    n_tris = int(lines[n_nodes + 1].split()[-1])
+    n_items = len(lines[1].split())
+    inds = range(3) if n_items in [3, 6, 14, 17] else range(1, 4)
+    pos = np.array([np.array([float(v) for v in l.split()])[inds]
+                   for l in lines[1:n_nodes + 1]])
+    tris = np.array([[int(l.split()[ind]) for ind in inds]
+                     for l in lines[n_nodes + 2:n_nodes + 2 + n_tris]])
+    tris -= np.min(tris)
+    return (pos, tris)
+
+def write_tri_lines(pos, tri, filename, norm):
+    with open(filename, 'w') as f:
+        f.write('- '+str(pos.shape[0])+'\n')
+        for ii in range(pos.shape[0]):
+            pnts = ' '.join([str(pos[ii][i]) for i in range(3)])
+            norms = ' '.join([str(norm[ii][i]) for i in range(3)])
+            f.write(pnts+' '+norms+'\n')
+        f.write('-'+(' '+str(tri.shape[0]))*3+'\n')
+        for ii in range(tri.shape[0]):
+            f.write(' '.join([str(tri[ii][i]) for i in range(3)])+'\n')
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func(*args)
+    return (time.perf_counter() - start) / REPEATS
+
+
+tmp = tempfile.mkdtemp()
+print('%-8s %8s %12s %12s %12s %12s' % ('surface', 'verts', 'load_old',
+      'load_new', 'write_old', 'write_new'))
+for shell in ['cortex', 'csf', 'skull', 'scalp']:
+    fn = os.path.join(DATADIR, shell+'.tri')
+    pos, tri = load_tri(fn)
+    norm = get_normals(pos, tri)
+    out = os.path.join(tmp, shell+'.tri')
+    times = [timeit(load_tri_lines, fn), timeit(load_tri, fn),
+             timeit(write_tri_lines, pos, tri, out, norm),
+             timeit(write_tri, pos, tri, out, norm)]
+    print('%-8s %8d %10.2fms %10.2fms %10.2fms %10.2fms' % tuple([shell,
+          len(pos)] + [1000*t for t in times]))
+    os.remove(out)
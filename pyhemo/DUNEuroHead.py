@@ -1,53 +1,107 @@
 #!/usr/bin/env python
 import duneuropy as dp
 import numpy as np
-import os
+import os, time, multiprocessing
 from pyhemo.msh_io import mat2msh, load_msh, elecs_mat2txt, sources_mat2txt
+from pyhemo.cache import get_cache, model_hash
+from pyhemo.leadfield import columns_per_dipole, allocate, relative_error, \
+                             rdm, mag, SourceSpace, Leadfield
+
+SOURCE_MODELS = {
+    'Partial integration' : {'type' : 'partial_integration'},
+    'Venant' : {
+        'type' : 'venant',
+        'numberOfMoments' : 3,
+        'referenceLength' : 20,
+        'weightingExponent' : 1,
+        'relaxationFactor' : 1e-6,
+        'mixedMoments' : False,
+        'restrict' : False,
+        'initialization' : 'closest_vertex'
+    },
+    'Subtraction' : {
+        'type' : 'subtraction',
+        'intorderadd' : 2,
+        'intorderadd_lb' : 2
+    },
+    'Spatial Venant' : {
+        'type' : 'spatial_venant',
+        'numberOfMoments' : 3,
+        'referenceLength' : 20,
+        'weightingExponent' : 1,
+        'relaxationFactor' : 1e-6,
+        'mixedMoments' : True,
+        'restrict' : True,
+        'initialization' : 'single_element',
+        'extensions' : ['vertex'],
+        'intorderadd' : 2
+    }
+}
+
+# Accuracy/speed trade-offs: CG reduction of the transfer matrix solves and
+# overrides of the integration orders of the source models (only applied to
+# source models having these parameters)
+PRESETS = {
+    'fast' : {
+        'reduction' : 1e-5,
+        'source_model' : {'intorderadd' : 0, 'intorderadd_lb' : 0}
+    },
+    'balanced' : {
+        'reduction' : 1e-8,
+        'source_model' : {'intorderadd' : 1, 'intorderadd_lb' : 1}
+    },
+    'reference' : {
+        'reduction' : 1e-12,
+        'source_model' : {}
+    }
+}
+
+def available_cpus():
+    """Number of CPUs this process may run on (respecting the affinity mask)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Head evaluated by the workers of DUNEuroHead.V_batch (inherited by fork,
+# as the driver cannot be pickled)
+_WORKER_HEAD = None
+
+def _init_worker(head, num_threads):
+    global _WORKER_HEAD
+    _WORKER_HEAD = head
+    _WORKER_HEAD.num_threads = num_threads
+
+def _worker_V(task):
+    source_model_type, col, dipoles, config = task
+    return source_model_type, col, _WORKER_HEAD._apply_transfer(dipoles, config)
+
+def _worker_sweep(task):
+    i, cond, dipoles, config = task
+    return i, _WORKER_HEAD._sweep_one(cond, dipoles, config)
 
 class DUNEuroHead(object):
-    def __init__(self, conductivity, geometry, elec_positions):
+    def __init__(self, conductivity, geometry, elec_positions, cache=None,
+                 num_threads=None, solver_config=None, reduction=1e-12,
+                 dtype=np.float64):
         # Geometry
         if isinstance(geometry, str):
             if geometry.endswith('.mat') and not os.path.exists(geometry[:-4]+'.msh'):
-                geometry = mat2msh(geometry)
-            no, el, lab, tiss = load_msh(geometry[:-4]+'.msh')
+                geometry = mat2msh(geometry, binary=True)
+            no, el, lab, tiss = load_msh(geometry[:-4]+'.msh', cache=cache)
         elif isinstance(geometry, list):
             no, el, lab, tiss = geometry
         else:
             raise ValueError
-        lab = {idx+1: l for idx, l in enumerate(lab)}
-        el = np.array(el)
+        lab = np.asarray(lab)
+        el = np.array(el, dtype=np.int64)
         el -= np.min(el)
-        self.nodes = no
+        self.nodes = np.asarray(no, dtype=np.float64)
         self.elems = el
-        self.labels = lab
+        self.labels = {idx+1: l for idx, l in enumerate(lab.tolist())}
         self.names = tiss
-        # Conductivity
-        if isinstance(conductivity, dict):
-            tensors = []
-            for idx, tissue in sorted(self.names.items()):
-                tensors += [conductivity[tissue] * np.identity(3)]
-            voxellabels = [l-1 for idx, l in sorted(lab.items())]
-        else:
-            raise ValueError
-        # Driver
-        config = {
-            'type' : 'fitted',
-            'solver_type' : 'cg',
-            'element_type' : 'tetrahedron',
-            'volume_conductor' : {
-                'grid' : {
-                    'elements': self.elems,
-                    'nodes': self.nodes
-                },
-                'tensors' : {
-                     'labels' : voxellabels,
-                     'tensors' : tensors
-                }
-            },
-            'solver' : {'verbose' : 1}
-        }
-        self.driver = dp.MEEGDriver3d(config)
+        self.cond = conductivity
+        self._voxellabels = (lab - 1).tolist()
         # Electrodes
         if isinstance(elec_positions, list) or isinstance(elec_positions, np.ndarray):
             self.electrodes = elec_positions
@@ -62,24 +116,155 @@ class DUNEuroHead(object):
             self.electrodes = [[float(x) for x in line.split()] for line in self.electrodes]
         else:
             raise ValueError
-        electrodes = [dp.FieldVector3D(elec) for elec in self.electrodes]
-        electrode_config = {
+        self.electrode_config = {
             'type' : 'closest_subentity_center',
             'codims' : [3]
         }
-        self.driver.setElectrodes(electrodes, electrode_config)
+        # Driver (solver settings such as the preconditioner, e.g.
+        # {'preconditioner_type' : 'amg', 'cg_smoother_type' : 'ssor'})
+        self.solver_config = dict({'verbose' : 1}, **(solver_config or {}))
+        self.driver = self._make_driver(self.cond)
+        # Persistent cache of h2em and V, keyed by everything they depend on
+        self.cache = get_cache(cache)
+        if self.cache is not None:
+            self._model_key = model_hash('duneuro', self.nodes, self.elems, lab,
+                                         self.names, self.cond, 'fitted', 'cg',
+                                         np.asarray(self.electrodes, dtype=float),
+                                         self.electrode_config)
+        # relative residual reduction of the CG solves of the transfer matrix
+        self.transfer_config = {'solver.reduction' : reduction}
+        self.source_model_overrides = {}
+        # Threads for computeEEGTransferMatrix and applyEEGTransfer
+        self.num_threads = num_threads if num_threads else available_cpus()
+        # per phase: number of calls, total and last wall time in seconds
+        self.timings = {}
+        # storage type of the leadfields (e.g. np.float32 to halve their
+        # memory), h2em is the input of applyEEGTransfer and stays float64
+        self.dtype = np.dtype(dtype)
         
         self._h2em = None # tm
         self._V = None
+        self._source_spaces = {}
+
+    def _make_driver(self, conductivity):
+        """MEEGDriver3d of the parsed mesh and electrodes for the given
+        conductivities (dict of tissue -> isotropic conductivity)"""
+        if isinstance(conductivity, dict):
+            tensors = []
+            for idx, tissue in sorted(self.names.items()):
+                tensors += [conductivity[tissue] * np.identity(3)]
+        else:
+            raise ValueError
+        config = {
+            'type' : 'fitted',
+            'solver_type' : 'cg',
+            'element_type' : 'tetrahedron',
+            'volume_conductor' : {
+                'grid' : {
+                    'elements': self.elems,
+                    'nodes': self.nodes.tolist() # lists, as from load_msh before
+                },
+                'tensors' : {
+                     'labels' : self._voxellabels,
+                     'tensors' : tensors
+                }
+            },
+            'solver' : self.solver_config
+        }
+        driver = dp.MEEGDriver3d(config)
+        electrodes = [dp.FieldVector3D(np.asarray(elec, dtype=float).tolist())
+                      for elec in self.electrodes]
+        driver.setElectrodes(electrodes, self.electrode_config)
+        return driver
+
+    def configure_solver(self, reduction=None, **solver_config):
+        """ Change the solver reduction and/or settings of the driver (e.g.
+        preconditioner_type), the transfer matrix and leadfields are
+        recomputed on next access """
+        if reduction is not None:
+            self.transfer_config = dict(self.transfer_config,
+                                        **{'solver.reduction' : reduction})
+        if solver_config:
+            self.solver_config = dict(self.solver_config, **solver_config)
+            self.driver = self._make_driver(self.cond)
+        self._h2em = None
+        self._V = None
+        self._source_spaces = {}
+
+    def use_preset(self, preset):
+        """Set solver reduction and source model parameters to one of
+        PRESETS ('fast', 'balanced' or 'reference')"""
+        if not preset in PRESETS.keys():
+            raise NotImplementedError
+        self.source_model_overrides = dict(PRESETS[preset]['source_model'])
+        self.configure_solver(reduction=PRESETS[preset]['reduction'])
+
+    def compare_presets(self, source_model_type, presets=('fast', 'balanced'),
+                        dipoles=None):
+        """ Leadfield error of presets against the 'reference' preset
+        Returns
+        -------
+        dict of preset -> dict with
+            'rel_error' : relative error (Frobenius norm) of the leadfield
+            'max_rdm', 'max_mag' : largest RDM and |1 - MAG| of all columns
+            'time' : seconds for transfer matrix and leadfield
+        """
+        dipoles = self.dipoles if dipoles is None else dipoles
+        state = (self.transfer_config, self.source_model_overrides,
+                 self._h2em, self._V, self._source_spaces)
+        V = {}
+        times = {}
+        try:
+            for preset in ('reference',) + tuple(presets):
+                self.use_preset(preset)
+                if preset == 'reference' and isinstance(state[2], np.ndarray) \
+                        and self.transfer_config == state[0]:
+                    self._h2em = state[2] # reference h2em of the head
+                start = time.time()
+                V[preset] = self._apply_transfer(dipoles,
+                    self._apply_config(source_model_type))
+                times[preset] = time.time() - start
+        finally:
+            (self.transfer_config, self.source_model_overrides, self._h2em,
+             self._V, self._source_spaces) = state
+        return {preset: {
+                    'rel_error' : relative_error(V[preset], V['reference']),
+                    'max_rdm' : np.max(rdm(V[preset], V['reference'])),
+                    'max_mag' : np.max(np.abs(1 - mag(V[preset],
+                                                      V['reference']))),
+                    'time' : times[preset]}
+                for preset in presets}
+
+    def _cached(self, name, compute, *key_items):
+        if self.cache is None:
+            return compute()
+        return self.cache.cached(name, compute, self._model_key,
+                                 self.solver_config, *key_items)
+
+    def _timed(self, phase, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        timing = self.timings.setdefault(phase, {'count' : 0, 'total' : 0.0,
+                                                 'last' : 0.0})
+        timing['count'] += 1
+        timing['total'] += elapsed
+        timing['last'] = elapsed
+        return result
     
     @property
     def h2em(self):
         """Compute/return the attribute transfer matrix h2em"""
         if not isinstance(self._h2em, np.ndarray):
-            self._h2em = np.array(self.driver.computeEEGTransferMatrix({
-                'solver.reduction' : 1e-12,
-                'numberOfThreads' : 2
-            })[0])
+            config = dict(self.transfer_config,
+                          numberOfThreads=self.num_threads)
+            h2em = self._cached('h2em', lambda: np.array(self._timed(
+                'computeEEGTransferMatrix',
+                self.driver.computeEEGTransferMatrix, config)[0]),
+                self.transfer_config)
+            # cached entries are read-only memory maps, applyEEGTransfer
+            # gets an in-memory array
+            self._h2em = np.array(h2em) if isinstance(h2em, np.memmap) else h2em
         return self._h2em
     
     def add_dipoles(self, dipole_locations):
@@ -93,64 +278,233 @@ class DUNEuroHead(object):
             self.dipoles = [[float(x) for x in line.split()] for line in lines]
         self._V = None
     
+    def _make_dipoles(self, dipoles):
+        if len(dipoles[0]) > 3:
+            pos = [[float(x) for x in line[:3]] for line in dipoles]
+            mom = [[float(x) for x in line[3:]] for line in dipoles]
+            return [dp.Dipole3d(p,m) for p,m in zip(pos, mom)]
+        elif len(dipoles[0]) == 3:
+            dipole_list = []
+            for p in dipoles:
+                p = [float(x) for x in p]
+                dipole_list.append(dp.Dipole3d(p, [1, 0, 0]))
+                dipole_list.append(dp.Dipole3d(p, [0, 1, 0]))
+                dipole_list.append(dp.Dipole3d(p, [0, 0, 1]))
+            return dipole_list
+        else:
+            raise ValueError
+
+    def _source_model_config(self, source_model_type):
+        if not source_model_type in SOURCE_MODELS.keys():
+            raise NotImplementedError
+        config = dict(SOURCE_MODELS[source_model_type])
+        config.update({key: value for key, value in
+                       self.source_model_overrides.items() if key in config})
+        return config
+
+    def _apply_config(self, source_model_type):
+        return {
+            'source_model' : self._source_model_config(source_model_type),
+            'post_process' : True,
+            'subtract_mean' : True
+        }
+
+    def _elecs_x_sources(self, V):
+        """Result of applyEEGTransfer (one row per source) as C-contiguous
+        elecs x sources leadfield, so Leadfield wraps it without a copy"""
+        return np.ascontiguousarray(np.array(V, dtype=self.dtype).T)
+
+    def _apply_transfer(self, dipoles, config):
+        V = self._timed('applyEEGTransfer', self.driver.applyEEGTransfer,
+                        self.h2em, self._make_dipoles(dipoles),
+                        dict(config, numberOfThreads=self.num_threads))[0]
+        return self._elecs_x_sources(V)
+
     #@property
     def V(self, source_model_type):
         if not isinstance(self._V, dict):
             self._V = {}
         if not source_model_type in self._V.keys():
-            if len(self.dipoles[0]) > 3:
-                pos = [[x for x in line[:3]] for line in self.dipoles]
-                mom = [[x for x in line[3:]] for line in self.dipoles]
-                dipoles = [dp.Dipole3d(p,m) for p,m in zip(pos, mom)]
-            elif len(self.dipoles[0]) == 3:
-                dipoles = []
-                for p in self.dipoles:
-                    dipoles.append(dp.Dipole3d(p, [1, 0, 0]))
-                    dipoles.append(dp.Dipole3d(p, [0, 1, 0]))
-                    dipoles.append(dp.Dipole3d(p, [0, 0, 1]))
-            else:
+            if len(self.dipoles[0]) < 3:
                 raise ValueError
-            if source_model_type == 'Partial integration':
-                source_model_config = {'type' : 'partial_integration'}
-            elif source_model_type == 'Venant':
-                source_model_config = {
-                    'type' : 'venant',
-                    'numberOfMoments' : 3,
-                    'referenceLength' : 20,
-                    'weightingExponent' : 1,
-                    'relaxationFactor' : 1e-6,
-                    'mixedMoments' : False,
-                    'restrict' : False,
-                    'initialization' : 'closest_vertex'
-                }
-            elif source_model_type == 'Subtraction':
-                source_model_config = {
-                    'type' : 'subtraction',
-                    'intorderadd' : 2,
-                    'intorderadd_lb' : 2
-                }
-            elif source_model_type == 'Spatial Venant':
-                source_model_config = {
-                    'type' : 'spatial_venant',
-                    'numberOfMoments' : 3,
-                    'referenceLength' : 20,
-                    'weightingExponent' : 1,
-                    'relaxationFactor' : 1e-6,
-                    'mixedMoments' : True,
-                    'restrict' : True,
-                    'initialization' : 'single_element',
-                    'extensions' : ['vertex'],
-                    'intorderadd' : 2
-                }
-            else:
-                raise NotImplementedError
-            V = self.driver.applyEEGTransfer(self.h2em, dipoles, {
-                'source_model' : source_model_config,
-                'post_process' : True,
-                'subtract_mean' : True,
-                'numberOfThreads' : 2
-            })[0]
-            self._V[source_model_type] = np.array(V).T # elecs x sources
+            config = self._apply_config(source_model_type)
+            self._V[source_model_type] = self._cached('V',
+                lambda: self._apply_transfer(self.dipoles, config),
+                self.transfer_config, np.asarray(self.dipoles, dtype=float),
+                config, self.dtype.str)
             #if len(self.dipoles[0]) == 3:
             #    self._V = self._V.reshape((len(self.electrodes), len(self.dipoles[0]), 3))
         return self._V[source_model_type]
+
+    def source_space(self, source_model_type):
+        """ Prepared SourceSpace of a source model: the leadfield columns of
+        every source position are computed once (new positions of a dipole
+        set in one applyEEGTransfer call) and reused for all later dipole
+        sets on this head """
+        if not source_model_type in self._source_spaces.keys():
+            config = self._apply_config(source_model_type)
+            self._source_spaces[source_model_type] = SourceSpace(
+                lambda positions: self._apply_transfer(positions, config),
+                len(self.electrodes), dtype=self.dtype)
+        return self._source_spaces[source_model_type]
+
+    def forward(self, pos, moment=None, source_model_type='Venant',
+                cache=False):
+        """ Electrode potentials of a single dipole, shape=(n_elecs,), or
+        without moment the gain of the x, y and z dipole at pos,
+        shape=(n_elecs, 3); positions stored in source_space only cost a
+        lookup, new positions are stored with cache=True (otherwise a dipole
+        with moment is computed as one oriented dipole) """
+        sources = self.source_space(source_model_type)
+        if moment is None or cache or pos in sources:
+            gain = sources.gain_at(pos, cache)
+            if moment is None:
+                return gain
+            return np.dot(gain, np.asarray(moment, dtype=gain.dtype))
+        dipole = np.hstack((np.asarray(pos, dtype=float)[:3], moment))
+        return self._apply_transfer([dipole],
+                                    self._apply_config(source_model_type))[:,0]
+
+    def leadfield(self, source_model_type, dipoles=None, dtype=None):
+        """ Leadfield of source positions (self.dipoles by default) as
+        Leadfield with a (n_elecs, n, 3) view, see pyhemo.leadfield """
+        if columns_per_dipole(self.dipoles if dipoles is None else dipoles) != 3:
+            raise ValueError
+        if dipoles is None:
+            return Leadfield(self.V(source_model_type), dtype=dtype)
+        return Leadfield(self.V_chunked(source_model_type, dipoles=dipoles),
+                         dtype=dtype)
+
+    def iter_V(self, source_model_type, chunk_size=1000, dipoles=None):
+        """Yield (first column, leadfield block) for chunk_size dipoles at a
+        time, so that only one block of Dipole3d objects is in memory"""
+        dipoles = self.dipoles if dipoles is None else dipoles
+        config = self._apply_config(source_model_type)
+        num_cols = columns_per_dipole(dipoles)
+        for start in range(0, len(dipoles), chunk_size):
+            yield start*num_cols, self._apply_transfer(
+                dipoles[start:start+chunk_size], config)
+
+    def V_chunked(self, source_model_type, chunk_size=1000, out=None,
+                  dipoles=None):
+        """Compute the leadfield chunk by chunk into out (None, a
+        preallocated array or a filename for a memory mapped .npy file)"""
+        dipoles = self.dipoles if dipoles is None else dipoles
+        out = allocate(out, (len(self.electrodes),
+                             columns_per_dipole(dipoles)*len(dipoles)),
+                       dtype=self.dtype)
+        for col, V in self.iter_V(source_model_type, chunk_size, dipoles):
+            out[:, col:col+V.shape[1]] = V
+        return out
+
+    def V_batch(self, source_model_types=None, dipoles=None, chunk_size=None,
+                num_workers=None):
+        """ Evaluate several source models (and dipole chunks) in parallel
+        Parameters
+        ----------
+        source_model_types : list of str
+            Defaults to all of SOURCE_MODELS.
+        dipoles : array
+            Defaults to self.dipoles, in which case the results are also
+            kept for V().
+        chunk_size : int
+            Dipoles per task, by default the dipoles are split so that there
+            is about one task per worker.
+        num_workers : int
+            Number of worker processes, defaults to available_cpus(). The
+            threads of the head are split among them.
+        Returns
+        -------
+        dict of source model type -> leadfield (elecs x sources)
+
+        The workers are forked from this process and share its h2em
+        copy-on-write, so it is neither copied nor pickled per worker.
+        """
+        if source_model_types is None:
+            source_model_types = list(SOURCE_MODELS.keys())
+        keep = dipoles is None
+        dipoles = self.dipoles if dipoles is None else dipoles
+        num_workers = num_workers if num_workers else available_cpus()
+        if chunk_size is None:
+            chunks = max(1, num_workers // len(source_model_types))
+            chunk_size = -(-len(dipoles) // chunks)
+        num_cols = columns_per_dipole(dipoles)
+        tasks = [(sm, start*num_cols, dipoles[start:start+chunk_size],
+                  self._apply_config(sm))
+                 for sm in source_model_types
+                 for start in range(0, len(dipoles), chunk_size)]
+        num_workers = min(num_workers, len(tasks))
+        V = {sm: allocate(None, (len(self.electrodes), num_cols*len(dipoles)),
+                          dtype=self.dtype)
+             for sm in source_model_types}
+        if num_workers < 2 or \
+                not 'fork' in multiprocessing.get_all_start_methods():
+            results = [(sm, col, self._apply_transfer(d, c))
+                       for sm, col, d, c in tasks]
+        else:
+            results = self._run_pool(tasks, num_workers)
+        for sm, col, block in results:
+            V[sm][:, col:col+block.shape[1]] = block
+        if keep:
+            if not isinstance(self._V, dict):
+                self._V = {}
+            self._V.update(V)
+        return V
+
+    def _run_pool(self, tasks, num_workers):
+        # the forked workers share the pages of h2em (copy-on-write, it is
+        # only read), so it is computed once here and neither copied nor
+        # pickled per worker
+        self.h2em
+        threads = max(1, self.num_threads // num_workers)
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(num_workers, _init_worker, (self, threads)) as pool:
+            return pool.map(_worker_V, tasks, chunksize=1)
+
+    def _sweep_one(self, cond, dipoles, config):
+        driver = self._make_driver(cond)
+        h2em = np.array(self._timed('computeEEGTransferMatrix',
+            driver.computeEEGTransferMatrix, dict(self.transfer_config,
+            numberOfThreads=self.num_threads))[0])
+        V = self._timed('applyEEGTransfer', driver.applyEEGTransfer, h2em,
+                        self._make_dipoles(dipoles),
+                        dict(config, numberOfThreads=self.num_threads))[0]
+        return self._elecs_x_sources(V)
+
+    def V_sweep(self, conductivities, source_model_type, dipoles=None,
+                out=None, num_workers=1):
+        """ Leadfields for many conductivity sets of the same mesh and
+        electrodes (a new driver per set, without reparsing anything)
+        Parameters
+        ----------
+        conductivities : list of dict
+            Conductivity sets, missing tissues are taken from self.cond.
+        out : None, str or array
+            See leadfield.allocate.
+        num_workers : int
+            Number of conductivity sets computed in parallel (forked worker
+            processes sharing the threads of the head).
+        Returns
+        -------
+        array, shape=(n_cond, n_elecs, n_sources)
+        """
+        dipoles = self.dipoles if dipoles is None else dipoles
+        config = self._apply_config(source_model_type)
+        out = allocate(out, (len(conductivities), len(self.electrodes),
+                             columns_per_dipole(dipoles)*len(dipoles)),
+                       dtype=self.dtype)
+        tasks = [(i, dict(self.cond, **cond), dipoles, config)
+                 for i, cond in enumerate(conductivities)]
+        num_workers = min(num_workers if num_workers else available_cpus(),
+                          len(tasks))
+        if num_workers < 2 or \
+                not 'fork' in multiprocessing.get_all_start_methods():
+            for i, cond, d, conf in tasks:
+                out[i] = self._sweep_one(cond, d, conf)
+            return out
+        threads = max(1, self.num_threads // num_workers)
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(num_workers, _init_worker, (self, threads)) as pool:
+            for i, V in pool.imap_unordered(_worker_sweep, tasks):
+                out[i] = V
+        return out
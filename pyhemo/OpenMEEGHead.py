@@ -1,51 +1,90 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import os, itertools, tempfile
-from random import random 
+import os, itertools, tempfile, shutil
 from shutil import copyfile
 import numpy as np, openmeeg as om
+from scipy.linalg import lu_factor, lu_solve
 from pyhemo.data_io import *
-from pyhemo.geometry import create_geometry
+from pyhemo.geometry import create_geometry, make_geometry, make_sensors
+from pyhemo.cache import get_cache, model_hash, file_hash
+from pyhemo.leadfield import columns_per_dipole, allocate, SourceSpace, \
+                             Leadfield
 from collections import OrderedDict
 
 
 class OpenMEEGHead(object):
-    def __init__(self, conductivity, geometry, elec_positions):      
-        tmp = tempfile.mkdtemp()
+    def __init__(self, conductivity, geometry, elec_positions, cache=None,
+                 adjoint=None, export_dir=None, dtype=np.float64):
         if isinstance(geometry, dict):
+            # surfaces may also be given as tri-files
+            geometry = OrderedDict([(tissue, load_tri(bnd, cache=cache)
+                                     if isinstance(bnd, str) else bnd)
+                                    for tissue, bnd in geometry.items()])
             geom_out2inside = OrderedDict([(tissue, bnd) for tissue, bnd in
                                            reversed(geometry.items())])
-            fn_geom = os.path.join(tmp, str(int(random()*100000000))+'.geom')
-            write_geom_file(geom_out2inside, fn_geom)
             self.mesh_names = list(geom_out2inside.keys()) # out to inside
         else:
             raise ValueError
         self.geometry = geometry # inside to outside
         self.cond = conductivity
-        fn_cond = os.path.join(tmp, str(int(random()*100000000))+'.cond')
-        write_cond_file(self.cond, fn_cond)
+        if not isinstance(elec_positions, (list, np.ndarray, str)):
+            raise ValueError
         self.elec_positions = elec_positions
-        fn_elec = os.path.join(tmp, str(int(random()*100000000))+'.elec')
-        if isinstance(elec_positions, list) or isinstance(elec_positions,
-                                                          np.ndarray):
-            write_elec_file(elec_positions, fn_elec)
-        elif isinstance(elec_positions, str):
-            copyfile(elec_positions, fn_elec)
+        # optional export of the geom, cond, elec and tri-files (debugging)
+        if export_dir is not None:
+            self.export(export_dir)
+        if hasattr(om, 'make_geometry'):
+            # build geometry and sensors in memory
+            self.geom = make_geometry(geom_out2inside, self.cond)
+            self.sens = make_sensors(elec_positions, self.geom)
         else:
-            raise ValueError
-        self.geom, self.sens = create_geometry(fn_geom, fn_cond, fn_elec)     
-        for fn in [fn_geom, fn_cond, fn_elec]:
-            os.remove(fn)    
-        if isinstance(geometry, dict):
-            for tissue in geometry.keys(): 
-                os.remove(os.path.join(tmp, tissue+'.tri'))
+            tmp = tempfile.mkdtemp()
+            self.geom, self.sens = create_geometry(*self.export(tmp))
+            shutil.rmtree(tmp)
         ##self.ind = self._get_indices_inside_out()
         self.ind = self._get_indices_outside_in()
+        # Persistent cache of A, h2em and V, keyed by everything they depend on
+        self.cache = get_cache(cache)
+        if self.cache is not None:
+            self._geom_key = model_hash('openmeeg', [(tissue, np.asarray(bnd[0],
+                                        dtype=float), np.asarray(bnd[1]))
+                                        for tissue, bnd in geometry.items()])
+            if isinstance(elec_positions, str):
+                self._elec_key = file_hash(elec_positions)
+            else:
+                self._elec_key = np.asarray(elec_positions, dtype=float)
+        else:
+            self._geom_key, self._elec_key = None, None
+        # adjoint: use the transfer matrix T = h2em A^-1 for leadfields
+        # (None: whenever there are more source columns than electrodes)
+        self.adjoint = adjoint
+        # storage type of h2em, T and leadfields (e.g. np.float32 to halve
+        # their memory), A and all solves stay in float64
+        self.dtype = np.dtype(dtype)
         self._A = None
+        self._lu = None
         self._Ainv = None
         self._h2em = None
+        self._T = None
         self._V = None
         self._condition_nb = None
+        self._source_spaces = {}
+
+    def export(self, directory):
+        """ Write the head as geom, cond, elec and tri-files into directory
+        and return the names of the geom, cond and elec-file """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fn_geom, fn_cond, fn_elec = [os.path.join(directory, 'head'+ext)
+                                     for ext in ['.geom', '.cond', '.elec']]
+        write_geom_file(OrderedDict([(tissue, self.geometry[tissue])
+                                     for tissue in self.mesh_names]), fn_geom)
+        write_cond_file(self.cond, fn_cond)
+        if isinstance(self.elec_positions, str):
+            copyfile(self.elec_positions, fn_elec)
+        else:
+            write_elec_file(self.elec_positions, fn_elec)
+        return fn_geom, fn_cond, fn_elec
 
     def _get_indices_outside_in(self):
         #idx = [i for i in range(self.geom.nb_meshes())]
@@ -79,37 +118,172 @@ class OpenMEEGHead(object):
         ind['V'] = [lst for lst in reversed(ind['V'])]
         ind['p'] = [lst for lst in reversed(ind['p'])]
         return ind
+
+    def _cached(self, name, compute, *key_items):
+        if self.cache is None:
+            return compute()
+        return self.cache.cached(name, compute, self._geom_key, *key_items)
+
+    def _store(self, array):
+        return np.asarray(array, dtype=self.dtype)
+
+    def _dot(self, M, x):
+        """M x in float64 (M with n_elecs rows is upcast, not the large x),
+        returned in the storage type"""
+        return self._store(np.dot(np.asarray(M, dtype=np.float64), x))
+
+    def _h2em_float64(self):
+        """h2em for solves, recomputed if it is stored in lower precision"""
+        if self.dtype == np.float64:
+            return self.h2em
+        return om.Matrix(om.Head2EEGMat(self.geom, self.sens)).array()
     
     @property
     def A(self):
         """Compute/return the attribute system matrix A"""
         if not isinstance(self._A, np.ndarray):
-            A = om.HeadMat(self.geom) #, self.GAUSS_ORDER)
-            self._A = om.Matrix(A).array()
+            self._A = self._cached('A', lambda: om.Matrix(om.HeadMat(
+                self.geom)).array(), self.cond) #, self.GAUSS_ORDER)
             #self._condition_nb = self.condition_nb
         return self._A
     @property
+    def lu(self):
+        """Compute/return the LU factorization of A (kept for all solves)"""
+        if self._lu is None:
+            self._lu = lu_factor(self.A)
+        return self._lu
+    def solve(self, b, transposed=False):
+        """Solve A x = b (or A^T x = b) with the stored factorization"""
+        return lu_solve(self.lu, b, trans=1 if transposed else 0)
+    @property
     def Ainv(self):
         """Compute/return the attribute system matrix A inverse"""
         if not isinstance(self._Ainv, np.ndarray):
-            print("Warning: inverting A explicitly...")
-            self._Ainv = np.linalg.pinv(self.A)
+            def compute():
+                print("Warning: inverting A explicitly...")
+                return self.solve(np.identity(self.A.shape[0]))
+            self._Ainv = self._cached('Ainv', compute, self.cond)
         return self._Ainv
     @property
     def h2em(self):
         """Compute/return the mapping from outer boundary to electrodes"""
         if not isinstance(self._h2em, np.ndarray):
-            h2em = om.Head2EEGMat(self.geom, self.sens)
-            self._h2em = om.Matrix(h2em).array()
+            self._h2em = self._cached('h2em', lambda: self._store(om.Matrix(
+                om.Head2EEGMat(self.geom, self.sens)).array()), self._elec_key,
+                self.dtype.str)
         return self._h2em
+    @property
+    def T(self):
+        """Compute/return the EEG transfer matrix T = h2em A^-1, solved as
+        A^T T^T = h2em^T with one right hand side per electrode"""
+        if not isinstance(self._T, np.ndarray):
+            self._T = self._cached('T', lambda: self._store(self.solve(
+                self._h2em_float64().T, transposed=True).T), self.cond,
+                self._elec_key, self.dtype.str)
+        return self._T
+
+    def _unknowns(self):
+        """Indices of the V (vertices) and p (triangles) unknowns in A of
+        every mesh from the outermost to the innermost one"""
+        num = len(self.mesh_names)
+        unknowns = []
+        for k in range(num):
+            mesh = self.geom.mesh(str(k+1))
+            V = np.array([v.index() for v in mesh.vertices()], dtype=int)
+            # the triangles of the outermost mesh are not included in A
+            p = np.array([t.index() for t in mesh.triangles()] if k else [],
+                         dtype=int)
+            unknowns.append((V, p))
+        return unknowns
+
+    def _block_scales(self, cond):
+        """Conductivity factors of the nonzero blocks of A: the single layer
+        (VV) blocks scale with sigma, the double layer (pp) blocks with
+        1/sigma and the Vp blocks do not depend on the conductivity"""
+        sigma = [cond[tissue] for tissue in self.mesh_names] # out to in
+        scales = {}
+        for k in range(len(sigma)):
+            sigma_out = sigma[k-1] if k else 0.0
+            scales[('V', k, 'V', k)] = sigma[k] + sigma_out
+            if k:
+                scales[('p', k, 'p', k)] = 1.0/sigma[k] + 1.0/sigma_out
+            if k+1 < len(sigma):
+                scales[('V', k, 'V', k+1)] = sigma[k]
+                scales[('V', k+1, 'V', k)] = sigma[k]
+                if k:
+                    scales[('p', k, 'p', k+1)] = 1.0/sigma[k]
+                    scales[('p', k+1, 'p', k)] = 1.0/sigma[k]
+        return scales
+
+    def V_sweep(self, conductivities, source_model_type='dsm', dipoles=None,
+                out=None):
+        """ Leadfields for many conductivity sets reusing the geometry only
+        operators: A and the source matrix are assembled once (for
+        self.cond) and only rescaled blockwise for every conductivity set
+        Parameters
+        ----------
+        conductivities : list of dict
+            Conductivity sets, missing tissues are taken from self.cond.
+        out : None, str or array
+            See leadfield.allocate.
+        Returns
+        -------
+        array, shape=(n_cond, n_elecs, n_sources)
+        """
+        dipoles = self.dipoles if dipoles is None else dipoles
+        domain = self._source_domain(source_model_type)
+        dsm = om.Matrix(om.DipSourceMat(self.geom, self._dipole_matrix(dipoles),
+                                        domain)).array()
+        out = allocate(out, (len(conductivities), self.sens.getNumberOfSensors(),
+                             dsm.shape[1]), dtype=self.dtype)
+        unknowns = self._unknowns()
+        p_rows = np.concatenate([p for _, p in unknowns])
+        ref_scales = self._block_scales(self.cond)
+        h2em = self._h2em_float64()
+        for i, cond in enumerate(conductivities):
+            cond = dict(self.cond, **cond)
+            A = self.A.copy()
+            for block, scale in self._block_scales(cond).items():
+                ratio = scale / ref_scales[block]
+                kind_a, a, kind_b, b = block
+                rows = unknowns[a][0 if kind_a == 'V' else 1]
+                cols = unknowns[b][0 if kind_b == 'V' else 1]
+                if ratio != 1.0 and len(rows) and len(cols):
+                    A[np.ix_(rows, cols)] *= ratio
+            # the p rows of the source matrix scale with 1/sigma of the source
+            # domain
+            rhs = dsm.copy()
+            rhs[p_rows] *= self.cond[domain] / cond[domain]
+            lu = lu_factor(A)
+            if dsm.shape[1] > self.sens.getNumberOfSensors():
+                out[i] = self._dot(lu_solve(lu, h2em.T, trans=1).T, rhs)
+            else:
+                out[i] = self._dot(h2em, lu_solve(lu, rhs))
+        return out
+
+    def _use_transfer(self, num_sources):
+        if self.adjoint is None:
+            return (isinstance(self._T, np.ndarray) or
+                    num_sources > self.sens.getNumberOfSensors())
+        return self.adjoint
+
+    def _leadfield(self, dsm, num_sources=None):
+        """Map source matrix dsm onto the electrodes (h2em A^-1 dsm)"""
+        num_sources = dsm.shape[1] if num_sources is None else num_sources
+        if self._use_transfer(num_sources):
+            # one matrix product with the (cached) transfer matrix
+            return self._dot(self.T, dsm)
+        elif isinstance(self._Ainv, np.ndarray):
+            # use precomputed Ainv
+            return self._dot(self.h2em, np.dot(self.Ainv, dsm))
+        # triangular solves with the factorized A
+        return self._dot(self.h2em, self.solve(dsm))
 
     def add_dipoles(self, dipole_locations):
         if isinstance(dipole_locations, list) or isinstance(dipole_locations,
                                                             np.ndarray):
             self.dipoles = dipole_locations 
-            fn_dip = os.path.join(tempfile.mkdtemp(),
-                                  'dipoles_'+str(int(random()*100000000)))
-            write_dip_file(self.dipoles, fn_dip)
+            fn_dip = None # kept in memory, see _dipole_matrix
         elif isinstance(dipole_locations, str):
             fn_dip = dipole_locations
             with open(fn_dip, 'r') as f:
@@ -120,24 +294,97 @@ class OpenMEEGHead(object):
         self.dipole_file = fn_dip 
         self._V = None
 
+    def _source_domain(self, source_model_type):
+        if source_model_type == 'dsm':
+            return self.mesh_names[0]
+        raise NotImplementedError
+
+    def _dipole_matrix(self, dipoles):
+        """Dipoles as om.Matrix, positions only are expanded into x, y and z
+        oriented dipoles"""
+        dipoles = np.asarray(dipoles, dtype=float)
+        if columns_per_dipole(dipoles) == 3:
+            dipoles = np.hstack((np.repeat(dipoles, 3, axis=0),
+                                 np.tile(np.identity(3), (len(dipoles), 1))))
+        return om.Matrix(np.asfortranarray(dipoles))
+
     def V(self, source_model_type):
         if not isinstance(self._V, dict):
             self._V = {}
         if not source_model_type in self._V.keys():
-            if source_model_type == 'dsm':
-                domain = self.mesh_names[0]
-            else:
-                raise NotImplementedError
-            #dipoles = om.Matrix(self.dipoles)
-            dipoles = om.Matrix(np.asfortranarray(self.dipoles))
-            dsm = om.DipSourceMat(self.geom, dipoles, domain)
-            dsm = om.Matrix(dsm).array()
-            if isinstance(self._Ainv, np.ndarray):
-                # use precomputed Ainv
-                L = self.h2em.dot(np.dot(self.Ainv, dsm))
-            else:
-                # faster
-                C = np.linalg.solve(self.A, dsm)
-                L = np.dot(self.h2em, C)
-            self._V[source_model_type] = L
+            domain = self._source_domain(source_model_type)
+            def compute():
+                dsm = om.DipSourceMat(self.geom,
+                                      self._dipole_matrix(self.dipoles), domain)
+                return self._leadfield(om.Matrix(dsm).array())
+            self._V[source_model_type] = self._cached('V', compute, self.cond,
+                self._elec_key, np.asarray(self.dipoles, dtype=float),
+                source_model_type, self.dtype.str)
         return self._V[source_model_type]
+
+    def source_space(self, source_model_type='dsm'):
+        """ Prepared SourceSpace of a source model: the leadfield columns of
+        every source position are computed once with the transfer matrix T
+        and reused for all later dipole sets on this head """
+        if not source_model_type in self._source_spaces.keys():
+            domain = self._source_domain(source_model_type)
+            def compute(positions):
+                dsm = om.DipSourceMat(self.geom,
+                                      self._dipole_matrix(positions), domain)
+                return self._dot(self.T, om.Matrix(dsm).array())
+            self._source_spaces[source_model_type] = SourceSpace(compute,
+                self.sens.getNumberOfSensors(), dtype=self.dtype)
+        return self._source_spaces[source_model_type]
+
+    def forward(self, pos, moment=None, source_model_type='dsm', cache=False):
+        """ Electrode potentials of a single dipole, shape=(n_elecs,), or
+        without moment the gain of the x, y and z dipole at pos,
+        shape=(n_elecs, 3); positions stored in source_space only cost a
+        lookup, new positions are stored with cache=True (otherwise a dipole
+        with moment is computed as one oriented dipole) """
+        sources = self.source_space(source_model_type)
+        if moment is None or cache or pos in sources:
+            gain = sources.gain_at(pos, cache)
+            if moment is None:
+                return gain
+            return np.dot(gain, np.asarray(moment, dtype=gain.dtype))
+        dipole = np.hstack((np.asarray(pos, dtype=float)[:3], moment))
+        dsm = om.Matrix(om.DipSourceMat(self.geom, self._dipole_matrix(
+            [dipole]), self._source_domain(source_model_type))).array()
+        if self.adjoint is False:
+            return self._leadfield(dsm)[:,0]
+        # one column mapped with the transfer matrix, as in source_space
+        return self._dot(self.T, dsm)[:,0]
+
+    def leadfield(self, source_model_type='dsm', dipoles=None, dtype=None):
+        """ Leadfield of source positions (self.dipoles by default) as
+        Leadfield with a (n_elecs, n, 3) view, see pyhemo.leadfield """
+        if columns_per_dipole(self.dipoles if dipoles is None else dipoles) != 3:
+            raise ValueError
+        if dipoles is None:
+            return Leadfield(self.V(source_model_type), dtype=dtype)
+        return Leadfield(self.V_chunked(source_model_type, dipoles=dipoles),
+                         dtype=dtype)
+
+    def iter_V(self, source_model_type, chunk_size=1000, dipoles=None):
+        """Yield (first column, leadfield block) for chunk_size dipoles at a
+        time, so that only one block of the source matrix is in memory"""
+        dipoles = self.dipoles if dipoles is None else dipoles
+        domain = self._source_domain(source_model_type)
+        num_cols = columns_per_dipole(dipoles)
+        for start in range(0, len(dipoles), chunk_size):
+            chunk = self._dipole_matrix(dipoles[start:start+chunk_size])
+            dsm = om.Matrix(om.DipSourceMat(self.geom, chunk, domain)).array()
+            yield start*num_cols, self._leadfield(dsm, num_cols*len(dipoles))
+
+    def V_chunked(self, source_model_type, chunk_size=1000, out=None,
+                  dipoles=None):
+        """Compute the leadfield chunk by chunk into out (None, a
+        preallocated array or a filename for a memory mapped .npy file)"""
+        dipoles = self.dipoles if dipoles is None else dipoles
+        out = allocate(out, (self.sens.getNumberOfSensors(),
+                             columns_per_dipole(dipoles)*len(dipoles)),
+                       dtype=self.dtype)
+        for col, L in self.iter_V(source_model_type, chunk_size, dipoles):
+            out[:, col:col+L.shape[1]] = L
+        return out
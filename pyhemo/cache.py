@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import os, json, shutil, hashlib, tempfile
+import numpy as np
+
+CACHE_DIR = os.environ.get('PYHEMO_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'pyhemo'))
+
+
+def file_hash(filename, blocksize=2**20):
+    """Return the sha1 hex digest of a file's content"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def model_hash(*items):
+    """Return a sha1 hex digest of (nested) dicts, lists, arrays, strings
+    and numbers, e.g. all inputs a matrix of a head model depends on"""
+    sha = hashlib.sha1()
+    _update_hash(sha, items)
+    return sha.hexdigest()
+
+def _update_hash(sha, item):
+    if isinstance(item, dict):
+        sha.update(b'{')
+        for key in sorted(item.keys(), key=str):
+            _update_hash(sha, key)
+            _update_hash(sha, item[key])
+        sha.update(b'}')
+    elif isinstance(item, (list, tuple)):
+        sha.update(b'[')
+        for i in item:
+            _update_hash(sha, i)
+        sha.update(b']')
+    elif isinstance(item, np.ndarray):
+        item = np.ascontiguousarray(item)
+        sha.update(('%s%s' % (item.dtype.str, item.shape)).encode())
+        sha.update(item.tobytes())
+    elif isinstance(item, np.generic):
+        _update_hash(sha, item.item())
+    else:
+        sha.update(('%s:%r;' % (type(item).__name__, item)).encode())
+
+
+class ArrayCache(object):
+    """ On-disk cache of named arrays.
+    Every entry is a directory <cache_dir>/<key>/ holding one .npy file per
+    array (loaded memory mapped) and an optional meta.json. Entries are
+    written to a temporary directory first and renamed into place, so
+    concurrent readers never see partially written entries. With max_size
+    (in bytes) the least recently used entries are evicted after each put.
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir if cache_dir else CACHE_DIR
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, mmap_mode='r'):
+        """Return (arrays, meta) stored under key or None"""
+        target = self.path(key)
+        if not os.path.isdir(target):
+            return None
+        try:
+            os.utime(target, None) # mark as recently used
+        except OSError:
+            return None # evicted in the meantime
+        arrays, meta = {}, None
+        try:
+            for fn in os.listdir(target):
+                if fn.endswith('.npy'):
+                    arrays[fn[:-4]] = np.load(os.path.join(target, fn),
+                                              mmap_mode=mmap_mode)
+                elif fn == 'meta.json':
+                    with open(os.path.join(target, fn), 'r') as f:
+                        meta = json.load(f)
+        except (OSError, IOError):
+            return None # evicted in the meantime
+        return arrays, meta
+
+    def put(self, key, arrays, meta=None):
+        """Store a dict of arrays (and json serializable meta) under key"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name+'.npy'), np.ascontiguousarray(arr))
+        if meta is not None:
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            # entry has been written by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.max_size is not None:
+            self.evict(self.max_size)
+        return self.path(key)
+
+    def entries(self):
+        """Return [(last access, size in bytes, key)] of all entries"""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            target = self.path(key)
+            if key.startswith('.tmp_') or not os.path.isdir(target):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(target, fn))
+                            for fn in os.listdir(target)])
+                entries.append((os.path.getmtime(target), size, key))
+            except OSError:
+                continue # evicted by another process
+        return entries
+
+    def evict(self, max_size):
+        """Remove least recently used entries until at most max_size bytes
+        are left"""
+        entries = sorted(self.entries())
+        total = sum([size for _, size, _ in entries])
+        for _, size, key in entries:
+            if total <= max_size:
+                break
+            # move out of the way first, so that readers never see a
+            # partially removed entry (open memory maps stay valid)
+            tmp = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+            try:
+                os.rename(self.path(key), os.path.join(tmp, key))
+            except OSError:
+                pass
+            shutil.rmtree(tmp, ignore_errors=True)
+            total -= size
+
+    def cached(self, name, compute, *key_items):
+        """Return the array stored for name and key_items or compute and
+        store it"""
+        key = name + '_' + model_hash(*key_items)
+        entry = self.get(key)
+        if entry is not None and name in entry[0]:
+            return entry[0][name]
+        value = compute()
+        self.put(key, {name: value})
+        return value
+
+
+def get_cache(cache):
+    """Turn the cache argument (None/False, True, a directory or an
+    ArrayCache) into an ArrayCache or None"""
+    if isinstance(cache, ArrayCache):
+        return cache
+    elif cache is True:
+        return ArrayCache()
+    elif isinstance(cache, str):
+        return ArrayCache(cache)
+    elif not cache:
+        return None
+    raise ValueError
@@ -2,6 +2,8 @@
 import os
 import numpy as np
 import h5py, scipy.io as sio
+from pyhemo.cache import get_cache, file_hash
+from pyhemo.topology import get_topology
 
 def sources_mat2txt(fn):
     data = {}
@@ -65,24 +67,22 @@ def write_elec_file(elec_positions, filename):
 
 
 def write_dip_file(dipole_positions, filename):
+    dipoles = np.asarray(dipole_positions, dtype=float)
+    if dipoles.shape[1] == 3:
+        # x, y and z oriented dipole at each position
+        dipoles = np.hstack((np.repeat(dipoles, 3, axis=0),
+                             np.tile(np.identity(3), (len(dipoles), 1))))
+    elif dipoles.shape[1] != 6:
+        raise NotImplementedError
     with open(filename, 'w') as f:
-        if len(dipole_positions[0]) == 3:
-            for d in dipole_positions:
-                f.write("%f\t%f\t%f\t%f\t%f\t%f\n" % (d[0],d[1],d[2], 1,0,0))
-                f.write("%f\t%f\t%f\t%f\t%f\t%f\n" % (d[0],d[1],d[2], 0,1,0))
-                f.write("%f\t%f\t%f\t%f\t%f\t%f\n" % (d[0],d[1],d[2], 0,0,1))
-        elif len(dipole_positions[0]) == 6:
-            for d in dipole_positions:
-                f.write("%f\t%f\t%f\t%f\t%f\t%f\n" % (d[0],d[1],d[2], 
-                                                      d[3],d[4],d[5]))
-        else:
-            raise NotImplementedError
+        f.write(_format_block(dipoles, '%f', sep='\t'))
     return
 
 
 
 
-def load_tri(filename='tmp.tri', normals=False, swap=False, print_warn=False):
+def load_tri(filename='tmp.tri', normals=False, swap=False, print_warn=False,
+             cache=None):
     """ Loads mesh from tri-file
     Parameters
     ----------
@@ -91,6 +91,9 @@ def load_tri(filename='tmp.tri', normals=False, swap=False, print_warn=False):
     swap : bool
         Assume the ASCII file vertex ordering is clockwise instead of
         counterclockwise.
+    cache : bool, str or ArrayCache
+        Keep the parsed arrays in an on-disk cache (keyed by the file's
+        content hash) and load them memory mapped from there.
     Returns
     -------
     pos : array, shape=(n_vertices, 3)
@@ -99,50 +102,53 @@ def load_tri(filename='tmp.tri', normals=False, swap=False, print_warn=False):
         Triangulation (each line contains indices for three points which
         together form a face).
     """
+    cache = get_cache(cache)
+    if cache is not None:
+        key = 'tri_' + file_hash(filename)
+        entry = cache.get(key)
+        if entry is None:
+            pos, tris = _parse_tri(filename, print_warn)
+            cache.put(key, {'pos': pos, 'tri': tris})
+        else:
+            pos, tris = entry[0]['pos'], entry[0]['tri']
+    else:
+        pos, tris = _parse_tri(filename, print_warn)
+    if swap:
+        tris = np.array(tris)
+        tris[:, [2, 1]] = tris[:, [1, 2]]
+    return (pos, tris)
+
+
+def _parse_tri(filename, print_warn=False):
     with open(filename, "r") as fid:
-        lines = fid.readlines()
-    #n_nodes = int(lines[0])
-    #n_tris = int(lines[n_nodes + 1])
+        lines = fid.read().splitlines()
     n_nodes = int(lines[0].split()[-1])
     n_tris = int(lines[n_nodes + 1].split()[-1])
-    """
-    # manual correction (if first faces, than pos)
-    if n_nodes > n_tris:
-        lines = lines[n_nodes+1:] + lines[:n_nodes+1]
-        n_nodes = int(lines[0])
-        n_tris = int(lines[n_nodes + 1])
-    """
     n_items = len(lines[1].split())
     if n_items in [3, 6, 14, 17]:
-        inds = range(3)
+        inds = slice(0, 3)
     elif n_items in [4, 7]:
-        inds = range(1, 4)
+        inds = slice(1, 4)
     else:
         raise IOError('Unrecognized format of data.')
-    pos = np.array([np.array([float(v) for v in l.split()])[inds]
-                   for l in lines[1:n_nodes + 1]])
-    # also corrected:
-    tris = np.array([[int(l.split()[ind]) for ind in inds]
-                     for l in lines[n_nodes + 2:n_nodes + 2 + n_tris]])
-    if swap:
-        tris[:, [2, 1]] = tris[:, [1, 2]]
-    tris -= 1
+    # parse both blocks in bulk instead of line by line
+    pos = _read_block(lines[1:n_nodes + 1], float)[:, inds]
+    tris = _read_block(lines[n_nodes + 2:n_nodes + 2 + n_tris], int)[:, inds]
+    pos, tris = np.ascontiguousarray(pos), np.ascontiguousarray(tris)
     if not n_items in [3, 4] and print_warn:
         print('Node normals were not read.')
     # ensure that tris start at zero
-    if np.min(tris) != 0:
-        tris -= np.min(tris)
-        """ 
-        tri_min = np.min(tris)
-        for i in range(len(tris)):
-            for j in range(len(tris[i])):
-                tris[i][j] -= tri_min
-        """ 
+    tris -= np.min(tris)
     return (pos, tris)
 
 
-
-
+def _read_block(lines, dtype):
+    """ Parse a block of equally long whitespace separated lines at once """
+    n_cols = len(lines[0].split()) if lines else 0
+    block = np.fromstring(' '.join(lines), dtype=dtype, sep=' ')
+    if block.size != len(lines) * n_cols:
+        raise IOError('Unrecognized format of data.')
+    return block.reshape((len(lines), n_cols))
 
 
 def calc_normal(p1, p2, p3):
@@ -159,15 +165,13 @@ def calc_normal(p1, p2, p3):
     return np.cross(p2-p1, p3-p1)
 
 def normals_for_faces(vertices, faces):
-    normals_f = np.zeros(faces.shape)
     # ensure that tris start at zero
     if np.min(faces) != 0:
         tri_min = np.min(faces)
         faces -= tri_min
-    for i, tri in enumerate(faces):
-        pos = [vertices[tri[ii]] for ii in range(3)]
-        normals_f[i,:] = calc_normal(*pos)
-    return normals_f
+    vertices = np.asarray(vertices, dtype=float)
+    p1, p2, p3 = vertices[faces[:,0]], vertices[faces[:,1]], vertices[faces[:,2]]
+    return calc_normal(p1, p2, p3)
 
 def get_normals(vertices, faces):
     normals_v = normals_for_faces(vertices, faces)
@@ -178,9 +182,10 @@ def get_normals(vertices, faces):
                                           normals_v, normalsIn=True)
     ### NEW: CHECK FOR NANS (+ dirty fix)
     nan_idx = set(np.argwhere(np.isnan(normals_v))[:,0])
+    if nan_idx:
+        topology = get_topology(vertices, faces)
     for idx in nan_idx:
-        neighbors = set([faces[t][i] for t in np.argwhere(faces==idx)[:,0] 
-                         for i in range(3)])  - {idx}
+        neighbors = topology.neighbors_of(idx)
         nrm = np.array([0.0, 0.0, 0.0])
         for n in neighbors:
             if (not np.isnan(normals_v[n]).any()):
@@ -205,7 +210,7 @@ def surface_area(vertices, faces):
     area = np.sqrt(pow((y2-y1)*(z3-z1)-(y3-y1)*(z2-z1), 2) +
 		   pow((z2-z1)*(x3-x1)-(z3-z1)*(x2-x1), 2) +
 		   pow((x2-x1)*(y3-y1)-(x3-x1)*(y2-y1), 2))
-    return sum(area)
+    return np.sum(area)
 
 def verts_normals_orientation(vertices, faces, normals, normalsIn):
     area1 = surface_area(vertices,faces)
@@ -220,26 +225,23 @@ def verts_normals_orientation(vertices, faces, normals, normalsIn):
         #normals = surface_normals(vertices,faces)
         normals_f = normals_for_faces(vertices, faces)
         normals = vertex_normals(faces, normals_f)
-    for i in range(normals.shape[0]):
-        norm_i = np.sqrt(np.sum([pow(normals[i,ii], 2) for ii in range(3)]))
-        normals[i,:] /= norm_i
-    return normals
+    return _normalize(normals)
 
 
-def vertex_normals(faces, face_normals):
-    normals = np.zeros((faces.max()+1, 3))
-    """
-    summed = np.zeros((vertex_count, 3))
-    for face, normal in zip(faces, face_normals):
-        summed[face] += normal
+def _normalize(normals):
+    """ Scale rows to unit length (rows of zeros become NaN) """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return normals / np.linalg.norm(normals, axis=1)[:,np.newaxis]
 
-    """
-    for i in range(faces.max()+1):
-        tris = np.argwhere(faces == i)[:,0]
-        normals[i,:] += np.sum(face_normals[np.ix_(tris)], axis=0)
-        norm_i = np.sqrt(np.sum([pow(normals[i,ii], 2) for ii in range(3)]))
-        normals[i,:] /= norm_i
-    return normals
+def vertex_normals(faces, face_normals):
+    """ Sum up the normals of all faces adjacent to each vertex and scale
+    them to unit length """
+    num = faces.max()+1
+    idx = faces.ravel()
+    normals = np.column_stack([np.bincount(idx, minlength=num,
+                                           weights=np.repeat(face_normals[:,i], 3))
+                               for i in range(3)])
+    return _normalize(normals)
 
 
 def write_tri(pos, tri, filename, normals=None):
@@ -254,20 +256,24 @@ def write_tri(pos, tri, filename, normals=None):
     filename : str
         Path for storing surface file (ending with '.tri').
     """
-    min_idx = np.min(np.array(tri).flatten())
-    pos = np.array(pos)
+    pos = np.array(pos, dtype=float)
     tri = np.array(tri, dtype=int)
+    tri = tri - np.min(tri)
     if isinstance(normals, list) or isinstance(normals, np.ndarray):
-        norm = normals
+        norm = np.array(normals, dtype=float)
     else:
-        norm = get_normals(pos, tri)    
+        norm = get_normals(pos, tri)
     with open(filename, 'w') as f:
         f.write('- '+str(pos.shape[0])+'\n')
-        for ii in range(pos.shape[0]):
-            pnts = ' '.join([str(pos[ii][i]) for i in range(3)])
-            norms = ' '.join([str(norm[ii][i]) for i in range(3)])
-            f.write(pnts+' '+norms+'\n')
+        f.write(_format_block(np.hstack((pos, norm)), '%r'))
         f.write('-'+(' '+str(tri.shape[0]))*3+'\n')
-        for ii in range(tri.shape[0]):
-            f.write(' '.join([str(tri[ii][i]-min_idx) for i in range(3)])+'\n')
-    return 
+        f.write(_format_block(tri, '%d'))
+    return
+
+
+def _format_block(block, fmt, sep=' '):
+    """ Format a 2d array as whitespace separated lines at once """
+    if block.size == 0:
+        return ''
+    line = sep.join([fmt] * block.shape[1]) + '\n'
+    return (line * block.shape[0]) % tuple(block.ravel().tolist())
@@ -1,17 +1,63 @@
 #!/usr/bin/env python
 import numpy as np
 import openmeeg as om
+try:
+    from openmeeg._openmeeg_wrapper import OrientedMesh, SimpleDomain
+except ImportError: # openmeeg < 2.5 (files only)
+    OrientedMesh, SimpleDomain = None, None
+from scipy.sparse import csr_matrix
+from pyhemo.topology import SurfaceTopology, get_topology
 #om.__version__ = 2.5.5
 
 
 def create_geometry(geom_file, cond_file, elec_file):
-    geometry = om.Geometry(geom_file, cond_file)
+    if hasattr(om, 'Geometry'):
+        geometry = om.Geometry(geom_file, cond_file)
+    else: # openmeeg >= 2.5
+        geometry = om.read_geometry(geom_file, cond_file)
     assert geometry.is_nested()
     #assert geometry.selfCheck()
     sensors = om.Sensors(elec_file)
     return geometry, sensors
 
 
+def make_geometry(geom_out2inside, cond):
+    """ Build the nested geometry described by write_geom_file and
+    write_cond_file directly from the surfaces in memory (openmeeg >= 2.5)
+    Parameters
+    ----------
+    geom_out2inside : dict
+        Surfaces (pos, tri) from the outermost to the innermost one, named
+        by tissue. The meshes are named '1' (outermost) to 'n'.
+    cond : dict
+        Conductivity of each tissue.
+    """
+    names = list(geom_out2inside.keys())
+    meshes, interfaces = {}, {}
+    domains = {'air': ([('1', SimpleDomain.Outside)], 0.0)}
+    for i, tissue in enumerate(names):
+        pos, tri = geom_out2inside[tissue]
+        mesh = str(i+1)
+        meshes[mesh] = (np.array(pos, dtype=np.float64),
+                        np.array(tri, dtype=np.int64))
+        interfaces[mesh] = [(mesh, OrientedMesh.Normal)]
+        boundaries = [(mesh, SimpleDomain.Inside)]
+        if i != len(names)-1:
+            boundaries.append((str(i+2), SimpleDomain.Outside))
+        domains[tissue] = (boundaries, cond[tissue])
+    geometry = om.make_geometry(meshes, interfaces, domains)
+    assert geometry.is_nested()
+    return geometry
+
+
+def make_sensors(elec_positions, geometry):
+    """ Sensors from an array of positions (or an electrode file) """
+    if isinstance(elec_positions, str):
+        return om.Sensors(elec_positions, geometry)
+    positions = np.asfortranarray(elec_positions, dtype=np.float64)
+    return om.Sensors(om.Matrix(positions), geometry)
+
+
 def mesh2bnd(mesh):
     min_idx = min([vert.index() for vert in mesh.vertices()])
     verts = np.zeros((len(mesh.vertices()), 3))
@@ -48,35 +94,107 @@ def getVolumeIndices(head):
 # The following code is adapted from fieldtrip's project_elec:
 # https://github.com/fieldtrip/fieldtrip/blob/master/private/project_elec.m
 def align_electrodes(elc, scalp):
-    pnt, tri = scalp
-    pnt, tri, elc = np.array(pnt), np.array(tri), np.array(elc)
-    Nelc = len(elc)
-    el   = np.zeros((Nelc, 4))
-    for i in range(Nelc):
-        proj, dist = ptriprojn(pnt[tri[:,0],:], pnt[tri[:,1],:],
-                               pnt[tri[:,2],:], np.array([elc[i,:]]), 1)
-        min_idx = np.argmin(abs(dist))
-        min_dist = np.min(abs(dist))
-        la, mu, _, _ = lmoutrn(pnt[np.newaxis, tri[min_idx,0],:],
-                               pnt[np.newaxis, tri[min_idx,1],:],
-                               pnt[np.newaxis, tri[min_idx,2],:],
-                               proj[np.newaxis, min_idx,:])
-        min_dist = dist[min_idx]
-        min_tri  = min_idx
-        min_la   = la[0]
-        min_mu   = mu[0]
-        # store the projection for this electrode
-        el[i,:] = np.array([min_tri, min_la, min_mu, min_dist])
-
-    prj = np.zeros((elc.shape))
-    for i in range(Nelc):
-        v1 = pnt[tri[int(el[i,0]),0],:]
-        v2 = pnt[tri[int(el[i,0]),1],:]
-        v3 = pnt[tri[int(el[i,0]),2],:]
-        la = el[i,1]
-        mu = el[i,2]
-        prj[i,:] = routlm(v1, v2, v3, la, mu)
-    return prj
+    return project_electrodes([elc], scalp)[0][0]
+
+
+def project_electrodes(montages, scalp):
+    """ Project several electrode sets onto the same scalp
+    Parameters
+    ----------
+    montages : list (or dict) of arrays, shape=(n_elecs, 3)
+        Electrode positions, positions occuring in several montages are only
+        projected once.
+    scalp : (pos, tri) or SurfaceTopology
+        Scalp surface, see get_topology.
+    Returns
+    -------
+    list (or dict) of (prj, tri_ids, bary) for every montage
+        prj : array, shape=(n_elecs, 3)
+            Projected electrode positions.
+        tri_ids : int array, shape=(n_elecs,)
+            Index of the scalp triangle of each projection.
+        bary : array, shape=(n_elecs, 3)
+            Barycentric coordinates of the projections with respect to the
+            corners of their triangles, see interpolation_matrix.
+    """
+    if isinstance(montages, dict):
+        names = list(montages.keys())
+        return dict(zip(names, project_electrodes([montages[n] for n in names],
+                                                  scalp)))
+    if isinstance(scalp, SurfaceTopology):
+        topology = scalp
+    else:
+        topology = get_topology(*scalp)
+    montages = [np.array(elc, dtype=float).reshape((-1, 3)) for elc in montages]
+    points, inv = np.unique(np.vstack(montages), axis=0, return_inverse=True)
+    inv = inv.ravel()
+    v1, v2, v3 = topology.corners
+    tri_ids = np.zeros(len(points), dtype=int)
+    bary = np.zeros((len(points), 3))
+    for i, point in enumerate(points):
+        min_idx, proj, _ = closest_triangle(topology, point)
+        la, mu, _, _ = lmoutrn(v1[np.newaxis, min_idx,:],
+                               v2[np.newaxis, min_idx,:],
+                               v3[np.newaxis, min_idx,:], proj[np.newaxis,:])
+        tri_ids[i] = min_idx
+        bary[i,:] = [1-la[0]-mu[0], la[0], mu[0]]
+    # same as routlm
+    prj = bary[:,0,np.newaxis]*v1[tri_ids] + bary[:,1,np.newaxis]*v2[tri_ids] \
+          + bary[:,2,np.newaxis]*v3[tri_ids]
+    result, start = [], 0
+    for elc in montages:
+        idx = inv[start:start+len(elc)]
+        result.append((prj[idx], tri_ids[idx], bary[idx]))
+        start += len(elc)
+    return result
+
+
+def interpolation_matrix(scalp, tri_ids, bary):
+    """ Sparse matrix, shape=(n_elecs, n_vertices), interpolating values at
+    the scalp vertices to the projected electrodes (see project_electrodes)
+    """
+    if isinstance(scalp, SurfaceTopology):
+        topology = scalp
+    else:
+        topology = get_topology(*scalp)
+    rows = np.repeat(np.arange(len(tri_ids)), 3)
+    cols = topology.tri[tri_ids].ravel()
+    return csr_matrix((np.asarray(bary).ravel(), (rows, cols)),
+                      shape=(len(tri_ids), topology.num_vertices))
+
+
+def closest_triangle(topology, point, k=8):
+    """ Find the triangle of a surface closest to a point
+    Parameters
+    ----------
+    topology : SurfaceTopology
+    point : array, shape=(3,)
+    k : int
+        Number of triangles with nearest centroids to start from.
+    Returns
+    -------
+    idx : int
+        Index of the closest triangle (the first one in case of ties, as
+        in a search over all triangles).
+    proj : array, shape=(3,)
+        Projection of point onto this triangle.
+    dist : float
+        Distance of point to proj (unsigned, the sign of lmoutrn depends on
+        the candidate triangles passed to it).
+    """
+    v1, v2, v3 = topology.corners
+    r = np.array([point], dtype=float)
+    _, near = topology.tree.query(point, min(k, len(v1)))
+    near = np.atleast_1d(near)
+    _, dist = ptriprojn(v1[near], v2[near], v3[near], r, 1)
+    # a triangle whose centroid is farther away than the best distance so
+    # far plus the largest centroid-corner distance cannot be closer
+    radius = np.min(abs(dist)) + topology.max_radius
+    cand = np.sort(topology.tree.query_ball_point(point,
+                                                  radius*(1+1e-9)+1e-12))
+    proj, dist = ptriprojn(v1[cand], v2[cand], v3[cand], r, 1)
+    min_idx = np.argmin(abs(dist))
+    return cand[min_idx], proj[min_idx], abs(dist[min_idx])
 
 
 def ptriprojn(v1, v2, v3, r, flag=0):
@@ -101,32 +219,35 @@ def ptriprojn(v1, v2, v3, r, flag=0):
 
 def lmoutrn(v1, v2, v3, r):
     # LMOUTRN computes the la/mu parameters of a point projected to triangles
-    if len(r) == 1 and len(v1) > 1:
-        r = np.repeat(r, len(v1)).T.reshape(v1.T.shape).T   
-
-    # compute la/mu parameters
+    # r is either one point or one point per triangle
     vec0 = r  - v1
     vec1 = v2 - v1
     #vec2 = v3 - v2
     vec3 = v3 - v1
-    origin = np.repeat(np.mean(np.vstack((v1, v2, v3)), axis=0),
-                       len(v1)).T.reshape(v1.T.shape).T     
-    tmp = np.empty((3, 2, len(v1)))
-    tmp[:,0,:] = vec1.T
-    tmp[:,1,:] = vec3.T
-    for i in range(len(v1)):
-        tmp[:,:,i] = np.linalg.pinv(tmp[:,:,i]).T
-
-    la = np.sum(np.multiply(vec0.T, tmp[:,0,:]), axis=0)
-    mu = np.sum(np.multiply(vec0.T, tmp[:,1,:]), axis=0)
-
-            
+
+    # compute la/mu parameters: closed form solution of the 2x2 normal
+    # equations [vec1 vec3]' [vec1 vec3] [la mu]' = [vec1 vec3]' vec0
+    a  = np.einsum('ij,ij->i', vec1, vec1)
+    b  = np.einsum('ij,ij->i', vec1, vec3)
+    c  = np.einsum('ij,ij->i', vec3, vec3)
+    d1 = np.einsum('ij,ij->i', vec0, vec1)
+    d3 = np.einsum('ij,ij->i', vec0, vec3)
+    # a*c - b*b without cancellation
+    det = np.sum(pow(np.cross(vec1, vec3), 2), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        la = (c*d1 - b*d3) / det
+        mu = (a*d3 - b*d1) / det
+    # degenerate triangles: least squares solution as before
+    for i in np.flatnonzero(det <= 1e-24 * pow(a+c, 2)):
+        la[i], mu[i] = np.linalg.pinv(np.column_stack((vec1[i],
+                                                       vec3[i]))).dot(vec0[i])
+
     # determine the projection onto the plane of the triangle
-    proj  = v1 + np.multiply(np.vstack((la, la, la)).T, vec1) \
-            + np.multiply(np.vstack((mu, mu, mu)).T, vec3)
+    proj  = v1 + la[:,np.newaxis] * vec1 + mu[:,np.newaxis] * vec3
 
     # determine the signed distance from the original point to its projection
     # where the sign is negative if the original point is closer to the origin 
+    origin = np.mean(np.vstack((v1, v2, v3)), axis=0)
     origin_r    = np.sum(pow((r    - origin), 2), axis=1)
     origin_proj = np.sum(pow((proj - origin), 2), axis=1)
 
@@ -152,11 +273,7 @@ def plinprojn(l1, l2, r, flag=False):
     t  = np.sum(np.multiply(dp, v), 1) / np.sum(pow(v, 2),1)
 
     if flag:
-        for i in range(len(t)):
-            if t[i] < 0:
-                t[i] = 0
-            if t[i] > 1:
-                t[i] = 1
+        t = np.clip(t, 0, 1)
 
     proj = l1 + np.vstack((np.multiply(t, v[:,0]), np.multiply(t, v[:,1]),
                            np.multiply(t, v[:,2]))).T
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+import numpy as np
+from collections import OrderedDict
+from scipy.spatial import ConvexHull
+from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
+
+
+def columns_per_dipole(dipoles):
+    """Number of leadfield columns per row of dipoles: 3 for positions only
+    (x, y and z oriented dipoles), 1 for positions with moments"""
+    num = len(dipoles[0])
+    if num == 3:
+        return 3
+    elif num == 6:
+        return 1
+    raise ValueError
+
+
+def allocate(out, shape, dtype=np.float64):
+    """ Return an output array for a leadfield of given shape
+    Parameters
+    ----------
+    out : None, str or array
+        None for a new array, a filename for a memory mapped .npy file or
+        a preallocated array (which is returned as is).
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                         shape=shape)
+    elif out.shape != shape:
+        raise ValueError('Output has shape %s instead of %s.' % (out.shape,
+                                                                 shape))
+    return out
+
+
+def relative_error(V, V_ref):
+    """Relative error ||V - V_ref|| / ||V_ref|| (Frobenius norm)"""
+    return np.linalg.norm(V - V_ref) / np.linalg.norm(V_ref)
+
+
+def rdm(V, V_ref):
+    """Relative difference measure of every column (0: same topography,
+    2: inverted topography)"""
+    return np.linalg.norm(V / np.linalg.norm(V, axis=0)
+                          - V_ref / np.linalg.norm(V_ref, axis=0), axis=0)
+
+
+def mag(V, V_ref):
+    """Magnitude ratio of every column (1: same magnitude)"""
+    return np.linalg.norm(V, axis=0) / np.linalg.norm(V_ref, axis=0)
+
+
+class SourceSpace(object):
+    """ Leadfield columns of the x, y and z oriented dipoles at each source
+    position, computed (in one batch for all new positions) on first request
+    and reused for every later dipole set containing that position
+    Parameters
+    ----------
+    compute : function
+        Positions, shape=(n, 3) -> leadfield, shape=(n_elecs, 3*n) with the
+        columns of the x, y and z dipole of each position.
+    num_electrodes : int
+    max_positions : int
+        Number of stored positions, the least recently used positions are
+        dropped beyond (None: no limit).
+    """
+    def __init__(self, compute, num_electrodes, dtype=np.float64,
+                 max_positions=10000):
+        self.compute = compute
+        self.num_electrodes = num_electrodes
+        self.max_positions = max_positions
+        # position (bytes) -> row of _gains, least recently used first
+        self._index = OrderedDict()
+        self._gains = np.empty((0, num_electrodes, 3), dtype=dtype)
+        self._count = 0 # used rows of _gains
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, position):
+        position = np.ascontiguousarray(position, dtype=np.float64)[:3]
+        return position.tobytes() in self._index
+
+    @property
+    def dtype(self):
+        return self._gains.dtype
+
+    def _keys(self, positions):
+        return [p.tobytes() for p in positions]
+
+    def _lookup(self, key):
+        """Row of a stored position (marked as recently used) or None"""
+        row = self._index.get(key)
+        if row is not None:
+            self._index.move_to_end(key)
+        return row
+
+    def _compute(self, positions):
+        V = np.asarray(self.compute(positions))
+        return np.transpose(V.reshape((self.num_electrodes, len(positions), 3)),
+                            (1, 0, 2))
+
+    def _store(self, keys, gains):
+        """Store the gains of new positions, the least recently used
+        positions are dropped beyond max_positions"""
+        size = self._count + len(keys)
+        if self.max_positions is not None:
+            keep = min(len(keys), self.max_positions)
+            keys, gains = keys[len(keys)-keep:], gains[len(keys)-keep:]
+            size = min(size, self.max_positions)
+        if size > len(self._gains):
+            size = max(size, 2*len(self._gains))
+            if self.max_positions is not None:
+                size = min(size, self.max_positions)
+            grown = np.empty((size, self.num_electrodes, 3), dtype=self.dtype)
+            grown[:self._count] = self._gains[:self._count]
+            self._gains = grown
+        for key, gain in zip(keys, gains):
+            if self._count < len(self._gains):
+                row = self._count
+                self._count += 1
+            else:
+                _, row = self._index.popitem(last=False)
+            self._gains[row] = gain
+            self._index[key] = row
+
+    def prepare(self, positions):
+        """Compute and store the columns of all positions not stored so far"""
+        self.gain(positions)
+
+    def gain(self, positions):
+        """Leadfield of the x, y and z dipoles, shape=(n, n_elecs, 3)"""
+        positions = np.ascontiguousarray(positions, dtype=np.float64)[:,:3]
+        keys = self._keys(positions)
+        gains = np.empty((len(positions), self.num_electrodes, 3),
+                         dtype=self.dtype)
+        # stored positions are copied before storing new ones may drop them
+        first = OrderedDict() # new position -> row of computed
+        new, missing = [], []
+        for i, key in enumerate(keys):
+            row = self._lookup(key)
+            if row is not None:
+                gains[i] = self._gains[row]
+                continue
+            if not key in first:
+                first[key] = len(new)
+                new.append(i)
+            missing.append(i)
+        if new:
+            computed = self._compute(positions[new])
+            gains[missing] = computed[[first[keys[i]] for i in missing]]
+            self._store(list(first.keys()), computed)
+        return gains
+
+    def gain_at(self, position, cache=True):
+        """Leadfield of the x, y and z dipole at one position,
+        shape=(n_elecs, 3) (a view into the stored columns), without cache
+        a new position is computed but not stored"""
+        position = np.ascontiguousarray(position, dtype=np.float64)[:3]
+        key = position.tobytes()
+        row = self._lookup(key)
+        if row is not None:
+            return self._gains[row]
+        gain = self._compute(position[np.newaxis,:])
+        if cache:
+            self._store([key], gain)
+        if key in self._index:
+            return self._gains[self._index[key]]
+        return gain[0].astype(self.dtype, copy=False)
+
+    def V(self, dipoles):
+        """Leadfield of dipoles (positions only: columns of the x, y and z
+        dipole of each position, with moments: one column per dipole)"""
+        dipoles = np.asarray(dipoles, dtype=np.float64)
+        gains = self.gain(dipoles)
+        if columns_per_dipole(dipoles) == 3:
+            return np.transpose(gains, (1, 0, 2)).reshape(
+                (self.num_electrodes, 3*len(dipoles)))
+        return np.einsum('nej,nj->en', gains, dipoles[:,3:6])
+
+
+def coarse_positions(positions, spacing):
+    """ Coarse subset of source positions: the first position in every cube
+    of a grid with the given edge length plus the vertices of the convex
+    hull of all positions (so that every position can be interpolated) """
+    positions = np.asarray(positions, dtype=np.float64)[:,:3]
+    cells = np.floor((positions - positions.min(axis=0)) / spacing)
+    _, first = np.unique(cells.astype(np.int64), axis=0, return_index=True)
+    return positions[np.union1d(first, ConvexHull(positions).vertices)]
+
+
+class InterpolatedSourceSpace(object):
+    """ Leadfield of a dense source space interpolated from the exact
+    leadfield at coarse positions, e.g. of head.source_space(sm)
+    Parameters
+    ----------
+    source_space : SourceSpace
+        Computes the exact gains, those of the positions are kept here
+        (independent of its max_positions) and only computed once.
+    positions : array, shape=(n, 3)
+        Positions with exact leadfields, see coarse_positions.
+    method : str
+        'linear' (piecewise linear on the Delaunay tetrahedra of the
+        positions, nearest position outside of their convex hull) or 'rbf'
+        (thin plate spline radial basis functions, needs scipy >= 1.7).
+    neighbors : int
+        Number of nearest positions used by 'rbf' (None: all positions).
+    """
+    def __init__(self, source_space, positions, method='linear',
+                 neighbors=None):
+        if not method in ('linear', 'rbf'):
+            raise NotImplementedError
+        self.source_space = source_space
+        self.method = method
+        self.neighbors = neighbors
+        self.positions = np.empty((0, 3))
+        self._keys = set() # positions (bytes)
+        # exact gains of the first len(_exact) positions
+        self._exact = np.empty((0, source_space.num_electrodes, 3),
+                               dtype=source_space.dtype)
+        self._interpolator = None
+        self.add_positions(positions)
+
+    @property
+    def num_electrodes(self):
+        return self.source_space.num_electrodes
+
+    def add_positions(self, positions):
+        """Add positions with exact leadfields (the interpolation is rebuilt
+        on next use)"""
+        positions = np.ascontiguousarray(positions, dtype=np.float64)[:,:3]
+        new = []
+        for i, p in enumerate(positions):
+            if not p.tobytes() in self._keys:
+                self._keys.add(p.tobytes())
+                new.append(i)
+        if new:
+            self.positions = np.vstack((self.positions, positions[new]))
+            self._interpolator = None
+
+    @property
+    def interpolator(self):
+        """Compute/return the interpolation of the exact gains"""
+        if self._interpolator is None:
+            if len(self._exact) < len(self.positions):
+                # only the positions added since the last build
+                self._exact = np.concatenate((self._exact,
+                    self.source_space.gain(self.positions[len(self._exact):])))
+            values = self._exact.reshape((len(self.positions),
+                                          3*self.num_electrodes))
+            if self.method == 'linear':
+                self._interpolator = (
+                    LinearNDInterpolator(self.positions, values),
+                    NearestNDInterpolator(self.positions, values))
+            else:
+                from scipy.interpolate import RBFInterpolator # scipy >= 1.7
+                self._interpolator = RBFInterpolator(self.positions, values,
+                                                     neighbors=self.neighbors)
+        return self._interpolator
+
+    def gain(self, positions):
+        """Interpolated leadfield of the x, y and z dipoles,
+        shape=(n, n_elecs, 3)"""
+        positions = np.asarray(positions, dtype=np.float64)[:,:3]
+        if self.method == 'linear':
+            linear, nearest = self.interpolator
+            values = linear(positions)
+            outside = np.isnan(values[:,0])
+            if np.any(outside):
+                values[outside] = nearest(positions[outside])
+        else:
+            values = self.interpolator(positions)
+        return values.reshape((len(positions), self.num_electrodes, 3)).astype(
+            self.source_space.dtype, copy=False)
+
+    def V(self, dipoles, chunk_size=10000, out=None):
+        """ Interpolated leadfield of dipoles in the layout of SourceSpace.V,
+        computed chunk by chunk into out (see allocate) """
+        dipoles = np.asarray(dipoles, dtype=np.float64)
+        num_cols = columns_per_dipole(dipoles)
+        out = allocate(out, (self.num_electrodes, num_cols*len(dipoles)),
+                       dtype=self.source_space.dtype)
+        for start in range(0, len(dipoles), chunk_size):
+            chunk = dipoles[start:start+chunk_size]
+            gains = self.gain(chunk)
+            if num_cols == 3:
+                out[:, 3*start:3*(start+len(chunk))] = np.transpose(
+                    gains, (1, 0, 2)).reshape((self.num_electrodes, -1))
+            else:
+                out[:, start:start+len(chunk)] = np.einsum('nej,nj->en', gains,
+                                                           chunk[:,3:6])
+        return out
+
+    def check(self, positions, num_samples=10, seed=None):
+        """ Relative error of the interpolated gain against the exact gain
+        at num_samples randomly chosen positions (spot samples)
+        Returns
+        -------
+        samples : array, shape=(num_samples, 3)
+        errors : array, shape=(num_samples,)
+        """
+        positions = np.asarray(positions, dtype=np.float64)[:,:3]
+        rng = np.random.RandomState(seed)
+        samples = positions[rng.choice(len(positions),
+                                       min(num_samples, len(positions)),
+                                       replace=False)]
+        # interpolate first, a rebuild may need samples of the last check
+        # that are still in the source space
+        approx = self.gain(samples)
+        exact = self.source_space.gain(samples)
+        errors = np.linalg.norm(approx - exact, axis=(1, 2)) \
+                 / np.linalg.norm(exact, axis=(1, 2))
+        return samples, errors
+
+    def refine(self, positions, tol, num_samples=10, max_iter=10, seed=None):
+        """ Check spot samples of positions and add those with an error above
+        tol to the exact positions, until all spot samples of a check are
+        within tol or max_iter refinements are done; returns the largest
+        error of the last check """
+        for i in range(max_iter+1):
+            samples, errors = self.check(positions, num_samples,
+                                         None if seed is None else seed+i)
+            if errors.max() <= tol or i == max_iter:
+                return errors.max()
+            self.add_positions(samples[errors > tol])
+
+
+class Leadfield(object):
+    """ Leadfield of x, y and z oriented dipoles at n positions, stored as
+    one (n_elecs, 3*n) array (the layout of V for positions only)
+    Parameters
+    ----------
+    V : array, shape=(n_elecs, 3*n)
+        Only copied if its layout or dtype has to be changed.
+    dtype : numpy dtype
+        Storage type, e.g. np.float32 to halve the memory.
+    """
+    def __init__(self, V, dtype=None):
+        self.data = np.ascontiguousarray(V, dtype=dtype)
+        if self.data.ndim != 2 or self.data.shape[1] % 3:
+            raise ValueError('Leadfield needs 3 columns per source position.')
+
+    @property
+    def num_electrodes(self):
+        return self.data.shape[0]
+
+    @property
+    def num_sources(self):
+        return self.data.shape[1] // 3
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def gain(self):
+        """View of shape (n_elecs, n, 3)"""
+        return self.data.reshape((self.num_electrodes, self.num_sources, 3))
+
+    def source(self, i):
+        """View of the (n_elecs, 3) gain of source position i"""
+        return self.data[:, 3*i:3*i+3]
+
+    def project(self, orientations, out=None):
+        """ Leadfield of fixed orientations (e.g. surface normals), shape=
+        (n_elecs, n), computed from the gain view without intermediate
+        copies
+        Parameters
+        ----------
+        orientations : array, shape=(n, 3)
+        out : None, str or array
+            See allocate.
+        """
+        orientations = np.asarray(orientations)
+        if orientations.shape != (self.num_sources, 3):
+            raise ValueError('Need one orientation per source position.')
+        out = allocate(out, (self.num_electrodes, self.num_sources),
+                       dtype=np.result_type(self.dtype, orientations.dtype))
+        return np.einsum('enj,nj->en', self.gain, orientations, out=out)
+
+    def astype(self, dtype):
+        return Leadfield(self.data, dtype=dtype)
@@ -1,6 +1,7 @@
-import sys, os, re
+import sys, os, re, itertools
 import numpy as np
 import h5py, scipy.io as sio
+from pyhemo.cache import get_cache, file_hash
 
 
 def elecs_mat2txt(fn):
@@ -42,79 +43,192 @@ def sources_mat2txt(fn):
     return fn[:-4]+'.txt'
 
 
-def load_msh(filename):
-    nodes = {}
-    elements = {}
-    labels = {}
-    names = {}
-    num_nodes, num_elems, num_names = None, None, None
-    two_lines = []
-    with open(filename, 'r') as f:
-        current = None
-        for line in f.readlines():
-            if line.strip().startswith('$End'):
-                current = None
-            elif line.strip().startswith('$MeshFormat'):
-                current = 'format'
-            elif line.strip().startswith('$Nodes'):
-                current = 'nodes'
-            elif line.strip().startswith('$Elements'):
-                current = 'elements'
-            elif line.strip().startswith('$PhysicalNames'):
-                current = 'names'
-            elif current == 'format':
-                print('Format version: %s' % line.strip())
-            elif current == 'nodes':
-                if not num_nodes:
-                    num_nodes = int(line.strip())
+def load_msh(filename, cache=None):
+    """ Stream a Gmsh 2.2 ASCII or binary file section by section into arrays.
+    Returns nodes (float64, n_nodes x 3), elements (int32, n_elems x 4),
+    labels (int32, n_elems) and the physical names {index: name}.
+    With cache (True, a directory or an ArrayCache) the arrays are stored
+    under the file's content hash and memory mapped on later calls.
+    """
+    cache = get_cache(cache)
+    if cache is not None:
+        key = 'msh_' + file_hash(filename)
+        entry = cache.get(key)
+        if entry is not None:
+            arrays, meta = entry
+            names = {int(idx): name for idx, name in meta['names'].items()}
+            return (arrays['nodes'], arrays['elements'], arrays['labels'],
+                    names)
+    nodes, elements, labels, names = _parse_msh(filename)
+    if cache is not None:
+        cache.put(key, {'nodes': nodes, 'elements': elements,
+                        'labels': labels}, meta={'names': names})
+    return nodes, elements, labels, names
+
+
+def _parse_msh(filename):
+    nodes, elements, labels, names = None, None, None, {}
+    byteorder = None # None for ASCII files
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(b'$End'):
+                continue
+            elif line.startswith(b'$MeshFormat'):
+                version = f.readline().decode().strip()
+                print('Format version: %s' % version)
+                if version.split()[1] == '1':
+                    byteorder = _read_byteorder(f)
+            elif line.startswith(b'$Nodes'):
+                if byteorder:
+                    nodes = _read_nodes_binary(f, byteorder)
                 else:
-                    node = [l.strip() for l in line.split()]
-                    node_idx = int(node[0])
-                    nodes[node_idx] = [float(node[1]), float(node[2]), float(node[3])]
-            elif current == 'elements':
-                if not num_elems:
-                    num_elems = int(line.strip())
-                elif not two_lines:
-                    elem = [e.strip() for e in line.split()]
-                    elem_idx = int(elem[0])
-                    elem_type = int(elem[1])
-                    num_of_tags = int(elem[2])
-                    phys_entity = int(elem[3])
-                    elem_geom_entity = int(elem[4])
-                    if num_of_tags == 2: # from msh_io
-                        elements[elem_idx] = [int(elem[3+num_of_tags+ii]) for ii in range(4)]
-                        labels[elem_idx] = elem_geom_entity
-                    elif num_of_tags == 3: # from iso2mesh
-                        two_lines = [elem_idx, elem_geom_entity]
-                    else:
-                        raise NotImplementedError
-                else: # second part of element info
-                    elem_idx, elem_geom_entity = two_lines
-                    elem = [e.strip() for e in line.split()]
-                    elements[elem_idx] = [int(elem[ii]) for ii in range(4)]
-                    labels[elem_idx] = elem_geom_entity
-                    two_lines = []
-            elif current == 'names':
-                if not num_names:
-                    num_names = int(line.strip())
+                    nodes = _read_nodes(f)
+            elif line.startswith(b'$Elements'):
+                if byteorder:
+                    elements, labels = _read_elements_binary(f, byteorder)
                 else:
-                    region_dim = int(line.split()[0].strip())
-                    names_idx = int(line.split()[1].strip())
-                    names[names_idx] = line.split()[2].strip().replace('"', '')
+                    elements, labels = _read_elements(f)
+            elif line.startswith(b'$PhysicalNames'):
+                names = _read_names(f)
             else:
                 raise ValueError
-
-    assert num_nodes == len(nodes)
-    assert num_elems == len(elements)
-    assert num_names == len(names)
-   
-    nodes = [n for _, n in sorted(nodes.items())]
-    elements = [e for _, e in sorted(elements.items())]
-    labels = [l for _, l in sorted(labels.items())]
     return nodes, elements, labels, names
 
 
-def write_msh(pos, tet, tissue, targetfilename):
+CHUNK_SIZE = 100000 # lines parsed at once
+NODES_PER_ELEM = {4: 4} # tetrahedra only
+
+
+def _read_lines(f, num):
+    lines = list(itertools.islice(f, num))
+    if len(lines) != num:
+        raise ValueError('Unexpected end of file.')
+    return lines
+
+def _parse_lines(lines, num_cols):
+    block = np.fromstring(b' '.join(lines), dtype=float, sep=' ')
+    if block.size != len(lines) * num_cols:
+        raise ValueError('Unrecognized format of data.')
+    return block.reshape((len(lines), num_cols))
+
+def _read_buffer(f, dtype, count):
+    dtype = np.dtype(dtype)
+    buf = f.read(dtype.itemsize * count)
+    if len(buf) != dtype.itemsize * count:
+        raise ValueError('Unexpected end of file.')
+    return np.frombuffer(buf, dtype=dtype, count=count)
+
+def _sort_by_index(idx, *arrays):
+    if (np.diff(idx) > 0).all():
+        return arrays
+    order = np.argsort(idx, kind='stable')
+    return tuple(a[order] for a in arrays)
+
+
+def _read_byteorder(f):
+    # the integer 1 written in the byte order of the file
+    one = f.read(4)
+    if np.frombuffer(one, dtype='<i4')[0] == 1:
+        return '<'
+    elif np.frombuffer(one, dtype='>i4')[0] == 1:
+        return '>'
+    raise ValueError('Unrecognized byte order.')
+
+
+def _read_nodes(f):
+    num_nodes = int(f.readline().strip())
+    idx = np.empty(num_nodes, dtype=np.int64)
+    nodes = np.empty((num_nodes, 3), dtype=np.float64)
+    for start in range(0, num_nodes, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, num_nodes)
+        block = _parse_lines(_read_lines(f, stop - start), 4)
+        idx[start:stop] = block[:, 0]
+        nodes[start:stop] = block[:, 1:]
+    nodes, = _sort_by_index(idx, nodes)
+    return nodes
+
+
+def _read_nodes_binary(f, byteorder):
+    num_nodes = int(f.readline().strip())
+    block = _read_buffer(f, [('idx', byteorder+'i4'),
+                             ('pos', byteorder+'f8', (3,))], num_nodes)
+    nodes = block['pos'].astype(np.float64)
+    nodes, = _sort_by_index(block['idx'], nodes)
+    return nodes
+
+
+def _read_elements(f):
+    num_elems = int(f.readline().strip())
+    idx = np.empty(num_elems, dtype=np.int64)
+    elements = np.empty((num_elems, 4), dtype=np.int32)
+    labels = np.empty(num_elems, dtype=np.int32)
+    if num_elems == 0:
+        return elements, labels
+    first = f.readline()
+    num_of_tags = int(first.split()[2])
+    if num_of_tags == 2: # from msh_io
+        lines_per_elem, num_head = 1, len(first.split()) - 4
+    elif num_of_tags == 3: # from iso2mesh (node indices on a second line)
+        lines_per_elem, num_head = 2, len(first.split())
+    else:
+        raise NotImplementedError
+    lines_iter = itertools.chain([first], f)
+    for start in range(0, num_elems, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, num_elems)
+        lines = _read_lines(lines_iter, lines_per_elem * (stop - start))
+        if lines_per_elem == 1:
+            block = _parse_lines(lines, num_head + 4)
+            head, elem = block[:, :num_head], block[:, num_head:]
+        else:
+            head = _parse_lines(lines[0::2], num_head)
+            elem = _parse_lines(lines[1::2], 4)
+        if (head[:, 2] != num_of_tags).any():
+            raise NotImplementedError
+        idx[start:stop] = head[:, 0]
+        labels[start:stop] = head[:, 4] # elementary geometrical entity
+        elements[start:stop] = elem
+    elements, labels = _sort_by_index(idx, elements, labels)
+    return elements, labels
+
+
+def _read_elements_binary(f, byteorder):
+    num_elems = int(f.readline().strip())
+    idx = np.empty(num_elems, dtype=np.int64)
+    elements = np.empty((num_elems, 4), dtype=np.int32)
+    labels = np.empty(num_elems, dtype=np.int32)
+    start = 0
+    while start < num_elems:
+        # element header: elm-type, num-elm-follow, num-tags
+        elem_type, num_follow, num_of_tags = _read_buffer(f, byteorder+'i4', 3)
+        if not elem_type in NODES_PER_ELEM or num_of_tags < 2:
+            raise NotImplementedError
+        num_cols = 1 + num_of_tags + NODES_PER_ELEM[elem_type]
+        block = _read_buffer(f, byteorder+'i4', num_follow * num_cols)
+        block = block.reshape((num_follow, num_cols))
+        stop = start + num_follow
+        idx[start:stop] = block[:, 0]
+        labels[start:stop] = block[:, 2] # elementary geometrical entity
+        elements[start:stop] = block[:, 1+num_of_tags:]
+        start = stop
+    elements, labels = _sort_by_index(idx, elements, labels)
+    return elements, labels
+
+
+def _read_names(f):
+    names = {}
+    num_names = int(f.readline().strip())
+    for line in _read_lines(f, num_names):
+        line = line.decode()
+        region_dim = int(line.split()[0].strip())
+        names_idx = int(line.split()[1].strip())
+        names[names_idx] = line.split()[2].strip().replace('"', '')
+    return names
+
+
+def write_msh(pos, tet, tissue, targetfilename, binary=False):
+    if binary:
+        return _write_msh_binary(pos, tet, tissue, targetfilename)
     with open(targetfilename, 'w') as f:
         f.write('$MeshFormat\n2.2 0 8\n$EndMeshFormat\n')
         # Nodes 
@@ -142,7 +256,41 @@ def write_msh(pos, tet, tissue, targetfilename):
         f.write('$EndPhysicalNames')
 
 
-def mat2msh(matfile):
+def _write_msh_binary(pos, tet, tissue, targetfilename):
+    pos, tet = np.asarray(pos), np.asarray(tet)
+    assert np.min(tet) == 1
+    assert len(tissue) == np.max(tet[:,4])
+    with open(targetfilename, 'wb') as f:
+        f.write(b'$MeshFormat\n2.2 1 8\n')
+        f.write(np.array(1, dtype='<i4').tobytes())
+        f.write(b'\n$EndMeshFormat\n')
+        # Nodes
+        nodes = np.empty(len(pos), dtype=[('idx', '<i4'), ('pos', '<f8', (3,))])
+        nodes['idx'] = np.arange(1, len(pos)+1)
+        nodes['pos'] = pos[:,:3]
+        f.write(b'$Nodes\n%d\n' % len(pos))
+        f.write(nodes.tobytes())
+        f.write(b'\n$EndNodes\n')
+        # Elements: one block of tetrahedra with tags (physical, geometrical)
+        elem_type, num_of_tags, phys_entity = 4, 2, 0
+        elems = np.empty((len(tet), 7), dtype='<i4')
+        elems[:,0] = np.arange(1, len(tet)+1)
+        elems[:,1] = phys_entity
+        elems[:,2] = tet[:,4]
+        elems[:,3:] = tet[:,:4]
+        f.write(b'$Elements\n%d\n' % len(tet))
+        f.write(np.array([elem_type, len(tet), num_of_tags], dtype='<i4').tobytes())
+        f.write(elems.tobytes())
+        f.write(b'\n$EndElements\n')
+        # Physical Names
+        f.write(b'$PhysicalNames\n%d\n' % len(tissue))
+        region_dim = 3
+        for t, tiss in enumerate(tissue):
+            f.write(('%d %d "%s"\n' % (region_dim, t+1, tiss)).encode())
+        f.write(b'$EndPhysicalNames')
+
+
+def mat2msh(matfile, binary=False):
     data = sio.loadmat(matfile)
     data = data['mesh'][0][0]
     if matfile.split('/')[-1].startswith('NY'):
@@ -163,7 +311,7 @@ def mat2msh(matfile):
         tissue = [data[5][0][t][0] for t in range(len(data[5][0]))]
         unit = data[4][0]
     #assert unit == 'mm'
-    write_msh(pos[:,:3], tet, tissue, matfile[:-4]+'.msh')
+    write_msh(pos[:,:3], tet, tissue, matfile[:-4]+'.msh', binary=binary)
     return matfile[:-4]+'.msh'
 """
 def mat2msh(matfile):
@@ -184,11 +332,13 @@ if __name__ == '__main__':
     """
     Run for example as
     python msh_io.py mesh5.mat
+    or with --binary for writing binary msh files.
     """
-    filenames = [arg for arg in sys.argv[1:]]
+    filenames = [arg for arg in sys.argv[1:] if arg != '--binary']
+    binary = '--binary' in sys.argv[1:]
     for i, matfile in enumerate(filenames):
         if matfile.endswith('.mat'):
-            _ = mat2msh(matfile)
+            _ = mat2msh(matfile, binary=binary)
         else:
             raise NotImplementedError
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import numpy as np
+from scipy.spatial import cKDTree
+from collections import OrderedDict
+from pyhemo.cache import model_hash
+
+# most recently used topologies by content hash of (pos, tri)
+MAX_CACHED = 8
+_TOPOLOGIES = OrderedDict()
+
+
+def _csr(rows, cols, num):
+    """ Compressed sparse rows: the cols of row i are
+    cols[ptr[i]:ptr[i+1]] (in ascending order of cols for equal rows) """
+    order = np.lexsort((cols, rows))
+    ptr = np.zeros(num+1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(rows, minlength=num))
+    return ptr, cols[order]
+
+
+class SurfaceTopology(object):
+    """ Adjacency of a triangulated surface, built once per (pos, tri)
+    Attributes
+    ----------
+    edges : int array, shape=(n_edges, 2)
+        Unique edges (i, j) with i < j.
+    vertex_faces_ptr, vertex_faces : int arrays
+        Faces adjacent to vertex i (CSR), see faces_of.
+    vertex_vertices_ptr, vertex_vertices : int arrays
+        Vertices sharing an edge with vertex i (CSR), see neighbors_of.
+    corners : tuple of three float arrays, shape=(n_faces, 3)
+        Coordinates of the first, second and third vertex of each face.
+    centroids, tree : float array, shape=(n_faces, 3) and cKDTree
+        Face centroids and a KD-tree over them (built on first use).
+    max_radius : float
+        Largest distance of a face corner to its centroid.
+    """
+    def __init__(self, pos, tri):
+        self.pos = np.array(pos, dtype=float)
+        self.tri = np.array(tri, dtype=np.int64)
+        self.num_vertices = max(len(self.pos), self.tri.max()+1)
+        num_faces = len(self.tri)
+        # vertex -> faces (a face is listed twice for degenerate triangles)
+        self.vertex_faces_ptr, self.vertex_faces = _csr(
+            self.tri.ravel(), np.repeat(np.arange(num_faces), 3),
+            self.num_vertices)
+        # edges and vertex -> vertices
+        edges = np.vstack((self.tri[:,[0,1]], self.tri[:,[1,2]],
+                           self.tri[:,[2,0]]))
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+        self.edges = edges[edges[:,0] != edges[:,1]]
+        self.vertex_vertices_ptr, self.vertex_vertices = _csr(
+            np.concatenate((self.edges[:,0], self.edges[:,1])),
+            np.concatenate((self.edges[:,1], self.edges[:,0])),
+            self.num_vertices)
+        self.corners = tuple([self.pos[self.tri[:,i]] for i in range(3)])
+        self.centroids = sum(self.corners) / 3.0
+        self.max_radius = max([np.max(np.linalg.norm(c - self.centroids,
+                                                     axis=1))
+                               for c in self.corners])
+        self._tree = None
+
+    @property
+    def tree(self):
+        """Compute/return the KD-tree over the face centroids"""
+        if self._tree is None:
+            self._tree = cKDTree(self.centroids)
+        return self._tree
+
+    def faces_of(self, vertex):
+        """Indices of the faces adjacent to vertex"""
+        return self.vertex_faces[self.vertex_faces_ptr[vertex]:
+                                 self.vertex_faces_ptr[vertex+1]]
+
+    def neighbors_of(self, vertex):
+        """Indices of the vertices sharing an edge with vertex (ascending)"""
+        return self.vertex_vertices[self.vertex_vertices_ptr[vertex]:
+                                    self.vertex_vertices_ptr[vertex+1]]
+
+    def degrees(self):
+        """Number of neighboring vertices of each vertex"""
+        return np.diff(self.vertex_vertices_ptr)
+
+
+def get_topology(pos, tri):
+    """Return the SurfaceTopology of (pos, tri), reusing a previously built
+    one for a surface with identical content"""
+    pos, tri = np.asarray(pos, dtype=float), np.asarray(tri, dtype=np.int64)
+    key = model_hash(pos, tri)
+    if key in _TOPOLOGIES:
+        _TOPOLOGIES.move_to_end(key)
+    else:
+        _TOPOLOGIES[key] = SurfaceTopology(pos, tri)
+        while len(_TOPOLOGIES) > MAX_CACHED:
+            _TOPOLOGIES.popitem(last=False)
+    return _TOPOLOGIES[key]
@@ -1,7 +1,8 @@
-import os, pytest
+import os, pytest, tempfile, shutil
 import numpy as np
 import duneuropy as dp
-from pyhemo.DUNEuroHead import DUNEuroHead
+from pyhemo.DUNEuroHead import DUNEuroHead, available_cpus
+from pyhemo.leadfield import relative_error
 import sys
 sys.path.append('./tests')
 from data_for_testing import load_elecs_dips_txt
@@ -18,12 +19,22 @@ def test_DUNEuroHead():
     # different constructors
     fem1 = DUNEuroHead(cond, mesh_filename, sensors)
     fem2 = DUNEuroHead(cond, mesh_filename[:-4]+'.msh', sensors)
+    fem3 = DUNEuroHead(cond, mesh_filename[:-4]+'.msh', sensors, num_threads=1)
+    assert fem3.num_threads == 1
+    fem3 = DUNEuroHead(cond, mesh_filename[:-4]+'.msh', sensors, reduction=1e-8,
+                       solver_config={'preconditioner_type': 'amg'})
+    assert fem3.transfer_config['solver.reduction'] == 1e-8
+    assert fem3.solver_config['preconditioner_type'] == 'amg'
+    fem3.configure_solver(reduction=1e-6)
+    assert fem3.transfer_config['solver.reduction'] == 1e-6
+    assert fem1.num_threads == available_cpus() >= 1
     # electrodes
     assert len(fem1.electrodes) == len(sensors) 
     e = np.random.choice(len(sensors), 1)[0]
     assert (fem1.electrodes[e] == sensors[e])
     # h2em
     assert fem1.h2em.shape == (len(fem1.electrodes), len(fem1.nodes))
+    assert fem1.timings['computeEEGTransferMatrix']['count'] == 1
     # dipoles
     is_inner_elem = [l == 1 for k, l in sorted(fem1.labels.items())]
     inner_elems = fem1.elems[is_inner_elem]
@@ -35,4 +46,67 @@ def test_DUNEuroHead():
     sm_type = np.random.choice(['Partial integration', 'Venant', 'Subtraction', 'Spatial Venant'])
     V = fem1.V(sm_type)
     assert V.shape == (len(sensors), 2*3)
+    # chunked
+    V_chunked = fem1.V_chunked(sm_type, chunk_size=1)
+    assert np.allclose(V, V_chunked)
 
+    # parallel batch over source models and dipole chunks
+    V_batch = fem1.V_batch(['Venant', sm_type], chunk_size=1, num_workers=2)
+    assert np.allclose(V_batch[sm_type], V)
+    assert np.allclose(V_batch['Venant'], fem1.V('Venant'))
+    # conductivity sweep
+    V_sweep = fem1.V_sweep([{}, {'icosphere42': 0.1}], sm_type, num_workers=2)
+    assert V_sweep.shape == (2,) + V.shape
+    assert np.allclose(V_sweep[0], V)
+    fem4 = DUNEuroHead(dict(cond, icosphere42=0.1), mesh_filename, sensors)
+    fem4.add_dipoles(dipoles)
+    assert np.allclose(V_sweep[1], fem4.V(sm_type))
+    # accuracy of the presets against the reference on the icospheres
+    h2em = fem1.h2em
+    num_transfers = fem1.timings['computeEEGTransferMatrix']['count']
+    errors = fem1.compare_presets(sm_type, presets=('reference', 'fast'))
+    # the reference h2em of the head is reused and kept
+    assert fem1.h2em is h2em
+    assert fem1.timings['computeEEGTransferMatrix']['count'] == num_transfers + 1
+    assert sorted(errors.keys()) == ['fast', 'reference']
+    assert errors['reference']['rel_error'] == 0
+    assert np.isfinite(errors['fast']['rel_error'])
+    fem1.use_preset('fast')
+    assert fem1.transfer_config['solver.reduction'] == 1e-5
+    with pytest.raises(NotImplementedError):
+        fem1.use_preset('exact')
+    # prepared source space
+    fem1.use_preset('reference')
+    sources = fem1.source_space(sm_type)
+    assert np.allclose(sources.V(dipoles), fem1.V(sm_type))
+    assert sources is fem1.source_space(sm_type)
+    # single dipole forward
+    d = np.array(dipoles[0])
+    assert np.allclose(fem1.forward(d, [0, 1, 0], sm_type), V[:,1])
+    gain = fem1.forward(d, source_model_type=sm_type, cache=True)
+    assert gain.shape == (len(sensors), 3)
+    assert np.shares_memory(fem1.forward(d, source_model_type=sm_type), gain)
+    assert np.allclose(fem1.forward(d, [0, 1, 0], sm_type), V[:,1])
+    # leadfield wraps V without a copy
+    lf = fem1.leadfield(sm_type)
+    assert lf.gain.shape == (len(sensors), 2, 3)
+    assert np.shares_memory(lf.data, fem1.V(sm_type))
+    # float32 storage of the leadfields
+    fem5 = DUNEuroHead(cond, mesh_filename, sensors, dtype=np.float32)
+    fem5.add_dipoles(dipoles)
+    V32 = fem5.V(sm_type)
+    assert V32.dtype == np.float32
+    assert relative_error(V32, V) < 1e-5
+    assert fem5.V_chunked(sm_type, chunk_size=1).dtype == np.float32
+    # cached mesh and h2em (read-only memory maps on the second head)
+    cache_dir = tempfile.mkdtemp()
+    fem6 = DUNEuroHead(cond, mesh_filename, sensors, cache=cache_dir)
+    fem6.add_dipoles(dipoles)
+    fem7 = DUNEuroHead(cond, mesh_filename, sensors, cache=cache_dir)
+    fem7.add_dipoles(dipoles)
+    fem7._V = None
+    assert not fem7.nodes.flags.writeable
+    assert np.allclose(fem7.h2em, fem6.h2em)
+    assert fem7.h2em.flags.writeable
+    assert np.allclose(fem7.forward(d, [0, 1, 0], sm_type), V[:,1])
+    shutil.rmtree(cache_dir)
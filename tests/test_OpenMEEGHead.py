@@ -1,8 +1,12 @@
-import os, pytest
+import os, pytest, tempfile, shutil
 import numpy as np
 import openmeeg as om
+import scipy.interpolate
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from pyhemo.OpenMEEGHead import OpenMEEGHead
+from pyhemo.geometry import create_geometry
+from pyhemo.leadfield import relative_error, coarse_positions, \
+                             InterpolatedSourceSpace
 import sys
 sys.path.append('./tests')
 from data_for_testing import simple_test_shapes, find_center_of_triangle
@@ -66,7 +70,117 @@ def test_OpenMEEGHead():
         head.V('msm')
     V = head.V('dsm')
     assert V.shape == (electrodes.shape[0],10)
+    # chunked
+    assert_array_almost_equal(V, head.V_chunked('dsm', chunk_size=3))
+    V_pos = head.V_chunked('dsm', chunk_size=4, dipoles=dips[:5,:3])
+    assert V_pos.shape == (electrodes.shape[0], 5*3)
+    lf = head.leadfield(dipoles=dips[:5,:3])
+    assert lf.gain.shape == (electrodes.shape[0], 5, 3)
+    assert_array_almost_equal(lf.data, V_pos)
+    # factorized solves
+    I = np.identity(head.A.shape[0])[:,:3]
+    assert_array_almost_equal(head.solve(head.A[:,:3]), I)
+    assert_array_almost_equal(head.solve(head.A.T[:,:3], transposed=True), I)
+    # transfer matrix (adjoint) path
+    assert head.T.shape == head.h2em.shape
+    head.adjoint, head._V = True, None
+    assert_array_almost_equal(V, head.V('dsm'))
+    head.adjoint, head._V = False, None
     Ainv = head.Ainv
     assert_array_almost_equal(V, head.V('dsm'))
+    # single dipole forward
+    dips = np.array(head.dipoles)
+    assert_array_almost_equal(head.forward(dips[0,:3], dips[0,3:]), V[:,0])
+    assert len(head.source_space()) == 0 # one oriented dipole, not stored
+    gain = head.forward(dips[1,:3], cache=True)
+    assert gain.shape == (electrodes.shape[0], 3)
+    assert_array_almost_equal(gain.dot(dips[1,3:]), V[:,1])
+    # stored positions return a view of the stored gain
+    assert np.shares_memory(head.forward(dips[1,:3]), gain)
+    assert_array_almost_equal(head.forward(dips[1,:3], dips[1,3:]), V[:,1])
+    assert len(head.source_space()) == 1
+    head.forward(dips[2,:3])
+    assert len(head.source_space()) == 1
+    # a fresh head maps new oriented dipoles with the transfer matrix
+    fresh = OpenMEEGHead(cond, geom, electrodes)
+    assert_array_almost_equal(fresh.forward(dips[3,:3], dips[3,3:]), V[:,3])
+    assert isinstance(fresh._T, np.ndarray)
+
+
+
+
+def _nested_head(num, cond=None, **kwargs):
+    """OpenMEEGHead of num nested test spheres tmp_tri1 (innermost) to
+    tmp_tri<num> with electrodes on the outermost one (random conductivities
+    by default)"""
+    bnds = simple_test_shapes(num_nested_meshes=num)
+    geom = OrderedDict([('tmp_tri%d' % (i+1), bnd) for i, bnd in enumerate(bnds)])
+    if cond is None:
+        cond = {tissue: np.random.rand() for tissue in geom.keys()}
+    electrodes = find_center_of_triangle(bnds[-1][0], bnds[-1][1])
+    return OpenMEEGHead(cond, geom, electrodes, **kwargs)
+
+
+def test_OpenMEEGHead_export():
+    export_dir = tempfile.mkdtemp()
+    head = _nested_head(np.random.randint(2, 4), export_dir=export_dir)
+    fn_geom, fn_cond, fn_elec = [os.path.join(export_dir, 'head'+ext)
+                                 for ext in ['.geom', '.cond', '.elec']]
+    geometry, sensors = create_geometry(fn_geom, fn_cond, fn_elec)
+    shutil.rmtree(export_dir)
+    # same system matrix as from the files
+    assert_array_almost_equal(head.A, om.Matrix(om.HeadMat(geometry)).array())
+    assert head.sens.getNumberOfSensors() == sensors.getNumberOfSensors()
+
+
+def test_OpenMEEGHead_V_sweep():
+    head = _nested_head(3)
+    dips = np.hstack((np.random.rand(4, 3) / 10, np.random.rand(4, 3)))
+    head.add_dipoles(dips)
+    sweep = [{'tmp_tri2': np.random.rand()}, {'tmp_tri1': np.random.rand()}]
+    V = head.V_sweep(sweep)
+    assert V.shape == (2, head.sens.getNumberOfSensors(), 4)
+    for i, new_cond in enumerate(sweep):
+        new_head = _nested_head(3, dict(head.cond, **new_cond))
+        new_head.add_dipoles(dips)
+        assert_array_almost_equal(V[i] / np.abs(V[i]).max(),
+                                  new_head.V('dsm') / np.abs(V[i]).max())
+
+
+def test_OpenMEEGHead_float32():
+    cond = {'tmp_tri1': 0.33, 'tmp_tri2': 0.0041, 'tmp_tri3': 0.33}
+    dips = np.random.rand(10, 3) / 20
+    head = _nested_head(3, cond)
+    head32 = _nested_head(3, cond, dtype=np.float32)
+    for adjoint in [True, False]:
+        head.adjoint = head32.adjoint = adjoint
+        head.add_dipoles(dips)
+        head32.add_dipoles(dips)
+        V, V32 = head.V('dsm'), head32.V('dsm')
+        assert V32.dtype == np.float32
+        assert relative_error(V32, V) < 1e-5
+    assert head32.h2em.dtype == np.float32
+    assert head32.h2em.nbytes * 2 == head.h2em.nbytes
+    assert head32.A.dtype == np.float64
+    assert head32.forward(dips[0], [1, 0, 0]).dtype == np.float32
+    assert head32.V_chunked('dsm', chunk_size=3).dtype == np.float32
 
 
+@pytest.mark.skipif(not hasattr(scipy.interpolate, 'RBFInterpolator'),
+                    reason='needs scipy >= 1.7')
+def test_OpenMEEGHead_interpolated():
+    head = _nested_head(3, {'tmp_tri1': 0.33, 'tmp_tri2': 0.0041,
+                            'tmp_tri3': 0.33})
+    # dense sources in the inner sphere, exact leadfields on a coarse subset
+    inner = simple_test_shapes(num_nested_meshes=1)[0][0]
+    radius = np.linalg.norm(inner, axis=1).min()
+    dips = np.random.rand(4000, 3) - 0.5
+    dips = 1.2 * radius * dips[np.linalg.norm(dips, axis=1) < 0.5]
+    sources = InterpolatedSourceSpace(head.source_space('dsm'),
+                                      coarse_positions(dips, 0.25*radius), 'rbf')
+    assert len(sources.positions) < len(dips) / 4
+    V = sources.V(dips)
+    assert V.shape == (head.sens.getNumberOfSensors(), 3*len(dips))
+    exact = head.source_space('dsm').V(dips[:50])
+    assert relative_error(V[:,:150], exact) < 0.1
+    assert sources.refine(dips, 0.1, seed=0) <= 0.1
@@ -0,0 +1,83 @@
+import os, pytest
+import numpy as np
+import tempfile
+from numpy.testing import assert_array_equal
+from pyhemo.cache import ArrayCache, get_cache, file_hash, model_hash
+from pyhemo.data_io import load_tri
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATADIR = os.path.join(BASEDIR, 'tests', 'test_data')
+
+
+def test_file_hash():
+    fn = os.path.join(DATADIR, 'scalp.tri')
+    assert file_hash(fn) == file_hash(fn)
+    assert file_hash(fn) != file_hash(os.path.join(DATADIR, 'skull.tri'))
+
+
+def test_array_cache():
+    cache = ArrayCache(tempfile.mkdtemp())
+    assert cache.get('key') is None
+    arrays = {'a': np.random.rand(5, 3), 'b': np.arange(4, dtype=np.int32)}
+    cache.put('key', arrays, meta={'names': {1: 'x'}})
+    # second writer of the same entry
+    cache.put('key', arrays)
+    loaded, meta = cache.get('key')
+    assert isinstance(loaded['a'], np.memmap)
+    assert_array_equal(loaded['a'], arrays['a'])
+    assert loaded['b'].dtype == np.int32
+    assert meta == {'names': {'1': 'x'}}
+    assert get_cache(cache) is cache
+    assert get_cache(None) is None
+    assert get_cache(cache.cache_dir).cache_dir == cache.cache_dir
+    with pytest.raises(ValueError):
+        get_cache(1.0)
+
+
+def test_model_hash():
+    arr = np.random.rand(4, 3)
+    key = model_hash(arr, {'scalp': 0.33, 'skull': 0.0041}, 'dsm')
+    assert key == model_hash(arr.copy(), {'skull': np.float64(0.0041),
+                                          'scalp': 0.33}, 'dsm')
+    assert key != model_hash(arr, {'scalp': 0.33, 'skull': 0.0042}, 'dsm')
+    assert key != model_hash(arr.astype(np.float32), {'scalp': 0.33,
+                                                      'skull': 0.0041}, 'dsm')
+    assert model_hash([1, 2]) != model_hash([[1, 2]])
+
+
+def test_array_cache_lru():
+    arr = np.random.rand(100)
+    cache = ArrayCache(tempfile.mkdtemp(), max_size=int(2.5*arr.nbytes))
+    calls = []
+    def compute():
+        calls.append(1)
+        return arr
+    for key in ['a', 'b']:
+        cache.cached('V', compute, key)
+    assert len(cache.entries()) == 2
+    for t, key in enumerate(['a', 'b']):
+        os.utime(cache.path('V_' + model_hash(key)), (t+1, t+1))
+    cache.cached('V', compute, 'a') # recently used
+    assert len(calls) == 2
+    cache.cached('V', compute, 'c') # evicts b
+    assert len(calls) == 3
+    assert len(cache.entries()) == 2
+    assert_array_equal(cache.cached('V', compute, 'a'), arr)
+    assert len(calls) == 3
+    cache.cached('V', compute, 'b')
+    assert len(calls) == 4
+    assert not [fn for fn in os.listdir(cache.cache_dir)
+                if fn.startswith('.tmp_')]
+
+
+def test_load_tri_cached():
+    cache_dir = tempfile.mkdtemp()
+    fn = os.path.join(DATADIR, 'scalp.tri')
+    pos, tri = load_tri(fn)
+    for _ in range(2):
+        pos_c, tri_c = load_tri(fn, cache=cache_dir)
+        assert_array_equal(pos, pos_c)
+        assert_array_equal(tri, tri_c)
+    assert isinstance(pos_c, np.memmap)
+    assert_array_equal(load_tri(fn, swap=True, cache=cache_dir)[1],
+                       load_tri(fn, swap=True)[1])
@@ -85,7 +85,36 @@ def test_write_load_tri():
     assert_array_equal(tri, new_tri)
 
 
+def test_get_normals():
+    tri_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'test_data', 'icosphere42.tri')
+    pos, tri = load_tri(tri_file)
+    normals = get_normals(pos, tri)
+    radial = pos - np.mean(pos, axis=0)
+    radial /= np.linalg.norm(radial, axis=1)[:,np.newaxis]
+    # unit normals pointing inwards
+    assert_array_almost_equal(np.sum(normals * radial, axis=1), -1, 3)
+    # per vertex sum of face normals
+    normals_f = normals_for_faces(pos, tri)
+    summed = np.zeros(pos.shape)
+    for face, normal in zip(tri, normals_f):
+        summed[face] += normal
+    summed /= np.linalg.norm(summed, axis=1)[:,np.newaxis]
+    assert_array_almost_equal(vertex_normals(tri, normals_f), summed)
+
+
 def test_write_bnd():
     # not in use anymore?
     assert True
 
+
+
+def test_write_dip_file():
+    pos = np.random.rand(4, 3)
+    dip_file = os.path.join(tempfile.mkdtemp(), 'tmp.dip')
+    write_dip_file(pos, dip_file)
+    dips = np.loadtxt(dip_file)
+    os.remove(dip_file)
+    assert dips.shape == (12, 6)
+    assert_array_almost_equal(dips[:,:3], np.repeat(pos, 3, axis=0), 6)
+    assert_array_equal(dips[:,3:], np.tile(np.identity(3), (4, 1)))
@@ -3,7 +3,10 @@ import numpy as np
 import openmeeg as om
 import random
 from numpy.testing import assert_array_equal, assert_array_almost_equal
-from pyhemo.geometry import create_geometry, mesh2bnd, align_electrodes
+from pyhemo.geometry import create_geometry, mesh2bnd, align_electrodes, \
+                            closest_triangle, ptriprojn, lmoutrn, \
+                            project_electrodes, interpolation_matrix
+from pyhemo.topology import get_topology
 from pyhemo.data_io import write_cond_file, write_geom_file, write_elec_file
 from tests.data_for_testing import simple_test_shapes, find_center_of_triangle, colin
 from collections import OrderedDict
@@ -87,3 +90,45 @@ def test_align_electrodes():
     dist = np.linalg.norm(elec_aligned-bnd_colin['electrodes_aligned'], axis=1)
     assert_array_almost_equal(dist, np.zeros(len(elec_aligned)), 2)
 
+
+
+def test_closest_triangle():
+    pnt, tri = colin()['scalp']
+    topology = get_topology(pnt, tri)
+    v1, v2, v3 = topology.corners
+    for point in np.random.randn(10, 3) * 100:
+        idx, proj, dist = closest_triangle(topology, point)
+        all_proj, all_dist = ptriprojn(v1, v2, v3, point[np.newaxis], 1)
+        assert idx == np.argmin(abs(all_dist))
+        assert_array_equal(proj, all_proj[idx])
+        assert dist == pytest.approx(abs(all_dist[idx]))
+
+
+def test_lmoutrn():
+    n = 100
+    v1, v2, v3 = [np.random.rand(n, 3) for _ in range(3)]
+    v3[0] = v1[0] + 2 * (v2[0] - v1[0]) # degenerate triangle
+    r = np.random.rand(1, 3)
+    la, mu, dist, proj = lmoutrn(v1, v2, v3, r)
+    for i in range(n):
+        pinv = np.linalg.pinv(np.column_stack((v2[i]-v1[i], v3[i]-v1[i])))
+        assert_array_almost_equal(pinv.dot(r[0]-v1[i]), [la[i], mu[i]])
+    assert_array_almost_equal(proj, v1 + la[:,np.newaxis] * (v2-v1) +
+                                    mu[:,np.newaxis] * (v3-v1))
+    assert_array_almost_equal(abs(dist), np.linalg.norm(r-proj, axis=1))
+
+
+def test_project_electrodes():
+    bnd_colin = colin()
+    elc = np.array(bnd_colin['electrodes_not_aligned'])
+    montages = {'all': elc, 'subset': elc[::3]}
+    scalp = get_topology(*bnd_colin['scalp'])
+    result = project_electrodes(montages, scalp)
+    prj, tri_ids, bary = result['all']
+    assert_array_equal(prj, align_electrodes(elc, bnd_colin['scalp']))
+    assert_array_equal(result['subset'][0], prj[::3])
+    assert_array_equal(result['subset'][1], tri_ids[::3])
+    assert_array_almost_equal(np.sum(bary, axis=1), 1)
+    interp = interpolation_matrix(scalp, tri_ids, bary)
+    assert interp.shape == (len(elc), len(scalp.pos))
+    assert_array_almost_equal(interp.dot(scalp.pos), prj)
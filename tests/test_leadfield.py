@@ -0,0 +1,147 @@
+import os, pytest
+import numpy as np
+import tempfile
+import scipy.interpolate
+from numpy.testing import assert_array_equal
+from pyhemo.leadfield import columns_per_dipole, allocate, relative_error, \
+                             rdm, mag, SourceSpace, Leadfield, \
+                             coarse_positions, InterpolatedSourceSpace
+
+
+def test_columns_per_dipole():
+    assert columns_per_dipole(np.random.rand(4, 3)) == 3
+    assert columns_per_dipole([[0, 0, 0, 1, 0, 0]]) == 1
+    with pytest.raises(ValueError):
+        columns_per_dipole([[0, 0]])
+
+
+def test_allocate():
+    assert allocate(None, (3, 4)).shape == (3, 4)
+    out = np.zeros((3, 4))
+    assert allocate(out, (3, 4)) is out
+    with pytest.raises(ValueError):
+        allocate(out, (4, 3))
+    fn = os.path.join(tempfile.mkdtemp(), 'V.npy')
+    out = allocate(fn, (3, 4))
+    out[:] = 1.0
+    out.flush()
+    assert_array_equal(np.load(fn), np.ones((3, 4)))
+
+
+def test_error_measures():
+    V_ref = np.random.rand(10, 4)
+    assert relative_error(V_ref, V_ref) == 0
+    assert relative_error(1.1 * V_ref, V_ref) == pytest.approx(0.1)
+    assert np.allclose(rdm(2 * V_ref, V_ref), 0)
+    assert np.allclose(rdm(-V_ref, V_ref), 2)
+    assert np.allclose(mag(2 * V_ref, V_ref), 2)
+
+
+def test_source_space():
+    gains = {}
+    calls = []
+    def compute(positions):
+        calls.append(len(positions))
+        for p in positions:
+            gains.setdefault(p.tobytes(), np.random.rand(5, 3))
+        return np.hstack([gains[p.tobytes()] for p in positions])
+    sources = SourceSpace(compute, 5)
+    pos = np.random.rand(4, 3)
+    V = sources.V(pos)
+    assert V.shape == (5, 12) and calls == [4]
+    # only new positions are computed (once)
+    more = np.vstack((pos[::-1], np.random.rand(1, 3), pos[:1]))
+    assert_array_equal(sources.V(more), compute(more))
+    assert calls[:2] == [4, 1] and len(sources) == 5
+    assert sources.gain(pos).shape == (4, 5, 3)
+    # fixed orientations
+    mom = np.random.rand(4, 3)
+    V_mom = sources.V(np.hstack((pos, mom)))
+    assert V_mom.shape == (5, 4)
+    assert np.allclose(V_mom[:,1], V[:,3:6].dot(mom[1]))
+
+
+def test_leadfield():
+    V = np.random.rand(5, 12)
+    lf = Leadfield(V)
+    assert lf.data is V
+    assert (lf.num_electrodes, lf.num_sources) == (5, 4)
+    assert np.shares_memory(lf.gain, V) and lf.gain.shape == (5, 4, 3)
+    assert_array_equal(lf.gain[:,2,:], V[:,6:9])
+    assert_array_equal(lf.source(2), V[:,6:9])
+    normals = np.random.rand(4, 3)
+    fixed = lf.project(normals)
+    assert fixed.shape == (5, 4)
+    assert np.allclose(fixed[:,1], V[:,3:6].dot(normals[1]))
+    lf32 = lf.astype(np.float32)
+    assert lf32.dtype == np.float32 and lf32.nbytes == lf.nbytes // 2
+    assert np.allclose(lf32.project(normals), fixed, rtol=1e-5)
+    with pytest.raises(ValueError):
+        Leadfield(np.random.rand(5, 4))
+
+
+def test_interpolated_source_space():
+    # potentials of dipoles in an infinite homogeneous medium
+    electrodes = np.random.randn(8, 3)
+    electrodes /= np.linalg.norm(electrodes, axis=1)[:,np.newaxis]
+    def compute(positions):
+        r = electrodes[:,np.newaxis,:] - positions[np.newaxis,:,:]
+        V = r / np.linalg.norm(r, axis=2)[:,:,np.newaxis]**3
+        return V.reshape((len(electrodes), 3*len(positions)))
+    positions = np.random.rand(8000, 3) - 0.5
+    positions = 0.5 * positions[np.linalg.norm(positions, axis=1) < 0.5]
+    coarse = coarse_positions(positions, 0.1)
+    assert len(coarse) < len(positions) / 5
+    methods = ['linear']
+    if hasattr(scipy.interpolate, 'RBFInterpolator'): # scipy >= 1.7
+        methods.append('rbf')
+    for method in methods:
+        sources = SourceSpace(compute, len(electrodes))
+        interp = InterpolatedSourceSpace(sources, coarse, method)
+        V = interp.V(positions, chunk_size=1000)
+        assert len(sources) == len(coarse) # exact gains computed on first use
+        assert relative_error(V, compute(positions)) < 0.05
+        samples, errors = interp.check(positions, num_samples=5, seed=0)
+        assert samples.shape == (5, 3) and np.all(errors < 0.1)
+        mom = np.random.rand(len(positions), 3)
+        assert np.allclose(interp.V(np.hstack((positions, mom)))[:,1],
+                           V[:,3:6].dot(mom[1]))
+        # spot samples above the error bound are added to the exact positions
+        assert interp.refine(positions, 1e-3, seed=0, max_iter=2) >= 0
+        assert len(interp.positions) > len(coarse)
+        assert interp.refine(positions, 0.1, seed=0) <= 0.1
+    # exact gains of the positions are kept beyond max_positions of the
+    # source space, refine only computes the spot samples
+    calls = []
+    def counted(positions):
+        calls.append(len(positions))
+        return compute(positions)
+    interp = InterpolatedSourceSpace(SourceSpace(counted, len(electrodes),
+                                                 max_positions=10), coarse)
+    interp.V(positions[:10])
+    assert sum(calls) == len(coarse)
+    interp.refine(positions, 1e-3, seed=0, max_iter=2)
+    assert sum(calls) <= len(coarse) + 3*10
+    with pytest.raises(NotImplementedError):
+        InterpolatedSourceSpace(sources, coarse, 'cubic')
+
+
+def test_source_space_max_positions():
+    calls = []
+    def compute(positions):
+        calls.append(len(positions))
+        return np.hstack([np.outer(np.arange(5), p) for p in positions])
+    sources = SourceSpace(compute, 5, max_positions=3)
+    pos = np.random.rand(5, 3)
+    # more new positions than fit: all are returned, the last ones stored
+    assert_array_equal(sources.V(pos), compute(pos))
+    assert len(sources) == 3 and len(sources._gains) == 3
+    sources.gain(pos[2:3]) # mark as recently used
+    sources.gain(pos[:1]) # drops pos[3], the least recently used
+    assert len(sources) == 3
+    calls[:] = []
+    sources.gain(pos[[0, 2, 4]])
+    assert calls == []
+    assert_array_equal(sources.gain_at(pos[3], cache=False), compute(pos[3:4]))
+    assert len(sources) == 3 and pos[3].tobytes() not in sources._index
+    assert np.shares_memory(sources.gain_at(pos[0]), sources._gains)
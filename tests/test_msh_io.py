@@ -1,5 +1,6 @@
-import os, pytest
+import os, pytest, tempfile
 import numpy as np
+from numpy.testing import assert_array_equal
 import duneuropy as dp 
 from data_for_testing import load_elecs_dips_txt
 from pyhemo.msh_io import *
@@ -29,6 +30,35 @@ def test_load_msh():
         assert last_tiss in tiss.values()
     return
 
+def test_load_msh_cached():
+    mesh_filename = os.path.join(DATADIR, 'icospheres.msh')
+    cache_dir = tempfile.mkdtemp()
+    no, el, lab, tiss = load_msh(mesh_filename)
+    for _ in range(2):
+        no_c, el_c, lab_c, tiss_c = load_msh(mesh_filename, cache=cache_dir)
+        assert_array_equal(no, no_c)
+        assert_array_equal(el, el_c)
+        assert_array_equal(lab, lab_c)
+        assert tiss == tiss_c
+    assert isinstance(no_c, np.memmap)
+
+def test_load_msh_iso2mesh():
+    # 3 tags with node indices on a second line, elements not sorted
+    targetfn = 'tmp_test.msh'
+    with open(targetfn, 'w') as f:
+        f.write('$MeshFormat\n2.2 0 8\n$EndMeshFormat\n$Nodes\n5\n')
+        f.write('2 1 0 0\n1 0 0 0\n3 0 1 0\n4 0 0 1\n5 1 1 1\n$EndNodes\n')
+        f.write('$Elements\n2\n2 4 3 0 2 0\n2 3 4 5\n1 4 3 0 1 0\n1 2 3 4\n')
+        f.write('$EndElements\n$PhysicalNames\n2\n3 1 "a"\n3 2 "b"\n')
+        f.write('$EndPhysicalNames\n')
+    no, el, lab, tiss = load_msh(targetfn)
+    os.remove(targetfn)
+    assert no.dtype == np.float64 and el.dtype == np.int32
+    assert_array_equal(no[:2], [[0, 0, 0], [1, 0, 0]])
+    assert_array_equal(el, [[1, 2, 3, 4], [2, 3, 4, 5]])
+    assert_array_equal(lab, [1, 2])
+    assert tiss == {1: 'a', 2: 'b'}
+
 def test_write_msh():
     nodes = np.random.rand(5,3)
     elems = [[1, 2, 3, 4, 1], [2, 3, 4, 5, 2]]
@@ -44,6 +74,22 @@ def test_write_msh():
     assert int(lines[14].split()[0]) == 2
     
 
+def test_write_load_msh_binary():
+    mesh_filename = os.path.join(DATADIR, 'icospheres.msh')
+    no, el, lab, tiss = load_msh(mesh_filename)
+    tet = np.hstack((el, lab[:,np.newaxis]))
+    names = [tiss[i] for i in sorted(tiss.keys())]
+    targetfn = 'tmp_test.msh'
+    write_msh(no, tet, names, targetfn, binary=True)
+    assert os.path.getsize(targetfn) < os.path.getsize(mesh_filename)
+    no2, el2, lab2, tiss2 = load_msh(targetfn)
+    os.remove(targetfn)
+    assert_array_equal(no, no2)
+    assert_array_equal(el, el2)
+    assert_array_equal(lab, lab2)
+    assert tiss == tiss2
+
+
 def test_mat2msh():
     # still in use?
     assert True
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+from numpy.testing import assert_array_equal
+from pyhemo.data_io import load_tri
+from pyhemo.topology import SurfaceTopology, get_topology
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DATADIR = os.path.join(BASEDIR, 'tests', 'test_data')
+
+
+def test_surface_topology():
+    pos, tri = load_tri(os.path.join(DATADIR, 'icosphere42.tri'))
+    topology = SurfaceTopology(pos, tri)
+    # closed surface: V - E + F = 2
+    assert len(pos) - len(topology.edges) + len(tri) == 2
+    assert topology.degrees().sum() == 2 * len(topology.edges)
+    for vertex in np.random.choice(len(pos), 5):
+        faces = np.argwhere(tri == vertex)[:,0]
+        assert_array_equal(np.sort(topology.faces_of(vertex)), faces)
+        neighbors = sorted(set(tri[faces].ravel()) - {vertex})
+        assert_array_equal(topology.neighbors_of(vertex), neighbors)
+    for i in range(3):
+        assert_array_equal(topology.corners[i], pos[tri[:,i]])
+
+
+def test_get_topology():
+    pos, tri = load_tri(os.path.join(DATADIR, 'icosphere42.tri'))
+    topology = get_topology(pos, tri)
+    assert get_topology(pos.copy(), tri.copy()) is topology
+    assert get_topology(pos + 1, tri) is not topology